@@ -3,19 +3,80 @@ import sys
 import os
 from pathlib import Path
 import tempfile
+import shutil
 import json
+import hashlib
+from collections import deque
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
 from core.pipeline.ingestion_pipeline import IngestionPipeline
 from core.pipeline.retrieval_pipeline import RetrievalPipeline
 from core.pipeline.emissions_pipeline import EmissionsPipeline
-from dotenv import load_dotenv
-from utils.api_validator import validate_api_keys, validate_endpoints
+from utils.env import load_env
+from utils.api_validator import validate_env
 
 # Load environment variables
-load_dotenv()
-validate_api_keys()
-validate_endpoints()
+load_env()
+validate_env()
+
+# Number of recent queries kept in the sidebar search history
+SEARCH_HISTORY_SIZE = 50
+
+# Uploads are copied and hashed in 1MB chunks so large PDFs are never held
+# in memory as a single bytes object
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def _hash_upload(uploaded_file):
+    """Compute a BLAKE2b content hash of an uploaded file (faster than SHA-256)"""
+    digest = hashlib.blake2b(digest_size=16)
+    uploaded_file.seek(0)
+    for chunk in iter(lambda: uploaded_file.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    uploaded_file.seek(0)
+    return digest.hexdigest()
+
+def _run_on_temp_pdf(uploaded_file, process):
+    """Stream an uploaded PDF to a temporary file, run `process` on its path and clean up"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
+        uploaded_file.seek(0)
+        shutil.copyfileobj(uploaded_file, tmp_file, length=UPLOAD_CHUNK_SIZE)
+        tmp_path = tmp_file.name
+    try:
+        return process(tmp_path)
+    finally:
+        os.remove(tmp_path)
+
+# Pipelines are created once per server process and shared by reference across
+# reruns and sessions, so concurrent uploads run on the same objects. Per-request
+# state (queued ingestion segments, pending flushes) is kept local to each call.
+@st.cache_resource(show_spinner=False)
+def get_ingestion():
+    return IngestionPipeline()
+
+@st.cache_resource(show_spinner=False)
+def get_retrieval(milvus_collection_name="vector_db"):
+    return RetrievalPipeline(milvus_collection_name)
+
+@st.cache_resource(show_spinner=False)
+def get_emissions(milvus_collection_name="vector_db"):
+    return EmissionsPipeline(milvus_collection_name)
+
+# Pipeline results are cached on disk keyed on the PDF content hash, so
+# re-uploading the same document skips the YOLOX/DePlot/OCR/LLM calls entirely.
+# Arguments prefixed with an underscore are excluded from the cache key.
+@st.cache_data(persist="disk", show_spinner=False, max_entries=64)
+def _ingest_cached(_pipeline, _uploaded_file, file_hash):
+    """Run the ingestion pipeline on an uploaded PDF, cached by content hash"""
+    return _run_on_temp_pdf(
+        _uploaded_file, lambda path: _pipeline.process_document(path, content_hash=file_hash)
+    )
+
+@st.cache_data(persist="disk", show_spinner=False, max_entries=64)
+def _emissions_cached(_pipeline, _uploaded_file, file_hash):
+    """Run the emissions pipeline on an uploaded PDF, cached by content hash"""
+    return _run_on_temp_pdf(
+        _uploaded_file, lambda path: _pipeline.process_document_for_emissions(path, content_hash=file_hash)
+    )
 
 class DocumentSearchApp:
     def __init__(self):
@@ -25,16 +86,20 @@ class DocumentSearchApp:
             layout="wide"
         )
         
-        # Initialize pipelines
-        self.ingestion = IngestionPipeline()
-        self.retrieval = RetrievalPipeline("vector_db")
-        self.emissions = EmissionsPipeline("vector_db")
+        # Get shared pipelines (constructed once, reused across reruns)
+        self.ingestion = get_ingestion()
+        self.retrieval = get_retrieval("vector_db")
+        self.emissions = get_emissions("vector_db")
         
         # Initialize session state
         if 'processed_documents' not in st.session_state:
             st.session_state.processed_documents = []
+        if 'processed_hashes' not in st.session_state:
+            st.session_state.processed_hashes = set()
         if 'search_history' not in st.session_state:
-            st.session_state.search_history = []
+            # Bounded history, with a set mirroring it for O(1) membership checks
+            st.session_state.search_history = deque(maxlen=SEARCH_HISTORY_SIZE)
+            st.session_state.search_history_set = set()
         if 'current_tab' not in st.session_state:
             st.session_state.current_tab = "search"
         if 'emissions_results' not in st.session_state:
@@ -59,40 +124,39 @@ class DocumentSearchApp:
             st.markdown("---")
             st.markdown("### Processed Documents")
             if st.session_state.processed_documents:
-                for doc in st.session_state.processed_documents:
-                    st.markdown(f"- {doc}")
+                st.markdown("\n".join(f"- {doc}" for doc in st.session_state.processed_documents))
             else:
                 st.markdown("*No documents processed yet*")
             
             st.markdown("---")
             st.markdown("### Search History")
             if st.session_state.search_history:
-                for query in st.session_state.search_history:
-                    st.markdown(f"- {query}")
+                st.markdown("\n".join(f"- {query}" for query in st.session_state.search_history))
             else:
                 st.markdown("*No search history*")
 
-    def process_document(self, uploaded_file):
+    def process_document(self, uploaded_file, file_hash=None):
         try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-
-            # Process document through pipeline
+            if file_hash is None:
+                file_hash = _hash_upload(uploaded_file)
+            
+            # Process document through pipeline (cached on file content)
             with st.spinner('Processing document...'):
-                result = self.ingestion.process_document(tmp_path)
+                result = _ingest_cached(self.ingestion, uploaded_file, file_hash)
                 
                 # Update UI with results
                 st.success(f"Successfully processed {uploaded_file.name}")
-                st.markdown("### Document Statistics")
-                st.markdown(f"- Text segments: {len(result['text'])}")
-                st.markdown(f"- Tables found: {len(result['tables'])}")
-                st.markdown(f"- Charts detected: {len(result['charts'])}")
+                st.markdown(
+                    "### Document Statistics\n"
+                    f"- Text segments: {len(result['text'])}\n"
+                    f"- Tables found: {len(result['tables'])}\n"
+                    f"- Charts detected: {len(result['charts'])}"
+                )
                 
                 # Add to processed documents list
                 if uploaded_file.name not in st.session_state.processed_documents:
                     st.session_state.processed_documents.append(uploaded_file.name)
+                st.session_state.processed_hashes.add(file_hash)
                 
             return True
             
@@ -106,8 +170,14 @@ class DocumentSearchApp:
             return []
             
         # Add to search history
-        if query not in st.session_state.search_history:
-            st.session_state.search_history.append(query)
+        history = st.session_state.search_history
+        history_set = st.session_state.search_history_set
+        if query not in history_set:
+            # Forget the entry the deque is about to evict
+            if len(history) == history.maxlen:
+                history_set.discard(history[0])
+            history.append(query)
+            history_set.add(query)
             
         # Process the query through the retrieval pipeline
         # Set generate_answer=True to use the LLM
@@ -117,14 +187,9 @@ class DocumentSearchApp:
     def calculate_emissions(self, uploaded_file):
         """Calculate emissions based on the document content"""
         try:
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_path = tmp_file.name
-
-            # Process document for emissions
+            # Process document for emissions (cached on file content)
             with st.spinner('Analyzing document for emissions...'):
-                result = self.emissions.process_document_for_emissions(tmp_path)
+                result = _emissions_cached(self.emissions, uploaded_file, _hash_upload(uploaded_file))
                 
                 # Store emissions results
                 st.session_state.emissions_results[uploaded_file.name] = result
@@ -162,7 +227,12 @@ class DocumentSearchApp:
         
         if uploaded_files:
             for uploaded_file in uploaded_files:
-                if self.process_document(uploaded_file):
+                # Files still sitting in the uploader are not processed again on
+                # later reruns (tab switches, sidebar clicks)
+                file_hash = _hash_upload(uploaded_file)
+                if file_hash in st.session_state.processed_hashes:
+                    continue
+                if self.process_document(uploaded_file, file_hash):
                     st.markdown("---")
         
         # Search Section
@@ -191,6 +261,9 @@ class DocumentSearchApp:
             if emission_result:
                 self.display_emissions_results(emission_result)
 
+    # Fragments rerun on their own when a widget inside them changes, instead
+    # of rerunning the whole script (uploaders, pipelines, other tab)
+    @st.fragment
     def display_emissions_results(self, results):
         st.markdown("## 🌍 Emissions Analysis Results")
         
@@ -240,22 +313,23 @@ class DocumentSearchApp:
                                 
                                 if 'parameters' in process:
                                     params = process['parameters']
-                                    st.markdown(f"Quantity: {params.get('quantity', 'N/A')}")
-                                    st.markdown(f"Emission Factor: {params.get('emission_factor', 'N/A')}")
-                                    st.markdown(f"Calculation: {params.get('calculation', 'N/A')}")
-                                    st.markdown(f"Total Emissions: {params.get('total_emissions', 'N/A')} kg CO2e")
+                                    # Markdown line breaks (two trailing spaces) keep one line per parameter
+                                    st.markdown(
+                                        f"Quantity: {params.get('quantity', 'N/A')}  \n"
+                                        f"Emission Factor: {params.get('emission_factor', 'N/A')}  \n"
+                                        f"Calculation: {params.get('calculation', 'N/A')}  \n"
+                                        f"Total Emissions: {params.get('total_emissions', 'N/A')} kg CO2e"
+                                    )
             
             # Display assumptions if any
             if 'assumptions' in emissions and emissions['assumptions']:
                 st.subheader("Assumptions")
-                for assumption in emissions['assumptions']:
-                    st.markdown(f"- {assumption}")
+                st.markdown("\n".join(f"- {assumption}" for assumption in emissions['assumptions']))
             
             # Display data sources if any
             if 'data_sources' in emissions and emissions['data_sources']:
                 st.subheader("Data Sources")
-                for source in emissions['data_sources']:
-                    st.markdown(f"- {source}")
+                st.markdown("\n".join(f"- {source}" for source in emissions['data_sources']))
             
             # Provide download option for the full results
             st.download_button(
@@ -265,13 +339,17 @@ class DocumentSearchApp:
                 mime="application/json"
             )
 
+    @st.fragment
     def search_documents(self):
         st.markdown("## Search Documents")
         
-        # Search query input
-        query = st.text_input("Enter your search query")
+        # Search query input; the form only reruns the search on submit,
+        # not on every edit of the text input
+        with st.form("search_form"):
+            query = st.text_input("Enter your search query")
+            submitted = st.form_submit_button("Search")
         
-        if st.button("Search") or query:
+        if submitted:
             if query:
                 with st.spinner("Searching..."):
                     results = self.search(query)
@@ -2,160 +2,428 @@ from .fitz_wrapper import fitz  # Safe import of PyMuPDF
 import cv2
 import numpy as np
 from PIL import Image
-import requests
+from utils.http_session import create_session
+from concurrent.futures import ThreadPoolExecutor
 import os
 import io
-import base64
+import hashlib
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
 
 class DocumentExtractor:
-    def __init__(self):
+    def __init__(self, max_workers=8, detection_batch_size=8, render_scale=1.0,
+                 duplicate_page_distance=None, min_confidence=0.5):
         self.yolox_key = os.getenv('NVIDIA_YOLOX_KEY')
         self.deplot_key = os.getenv('NVIDIA_DEPLOT_KEY')
         self.yolox_endpoint = os.getenv('NVIDIA_YOLOX_ENDPOINT')
         self.deplot_endpoint = os.getenv('NVIDIA_DEPLOT_ENDPOINT')
+        self.max_workers = max_workers  # Concurrent YOLOX/DePlot requests
+        self.detection_batch_size = detection_batch_size  # Pages per YOLOX request
+        self.min_confidence = min_confidence  # Detections below this are dropped
+        # Pixel-identical pages always share detections. Setting a max perceptual hash
+        # distance also lets near-duplicates share them once a thumbnail comparison
+        # confirms the match; off by default, since pages with the same layout but
+        # different content hash within a few bits of each other
+        self.duplicate_page_distance = duplicate_page_distance
         
-    def _detect_objects(self, image):
-        """Detect page elements using NVIDIA YOLOX"""
-        # Convert image to base64
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode('utf-8')
+        # Rasterization matrix shared by all pages (1.0 = 72 dpi). Payload size
+        # grows quadratically with the scale, so keep it as low as detection allows
+        self.page_matrix = fitz.Matrix(render_scale, render_scale)
         
+        # Upload images as JPEG (much cheaper to encode and send than PNG); a request
+        # the endpoint rejects as an unsupported image format is retried once as PNG
+        self.yolox_image_format = 'JPEG'
+        self.deplot_image_format = 'JPEG'
+        
+        # Shared session so concurrent requests reuse pooled connections
+        self.session = create_session()
+        
+    def close(self):
+        """Close the pooled HTTP connections"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _crop(self, pixels, bbox):
+        """Crop a bbox region out of a page array (a view, no copy)"""
+        x1, y1, x2, y2 = (max(0, int(round(v))) for v in bbox)
+        return pixels[y1:y2, x1:x2]
+    
+    def _encode_image(self, image, image_format, bbox=None, encode_cache=None):
+        """Encode a page array, or its bbox region, as a base64 data URL in the given format
+        
+        If `encode_cache` is given, encodings are memoized per image, region and
+        format so batch/format retries and repeated regions are not re-encoded.
+        """
+        cache_key = (id(image), tuple(bbox) if bbox is not None else None, image_format)
+        if encode_cache is not None and cache_key in encode_cache:
+            return encode_cache[cache_key]
+        
+        region = self._crop(image, bbox) if bbox is not None else image
+        if image_format == 'JPEG':
+            # OpenCV's libjpeg-turbo encoder is much faster than PIL's and
+            # releases the GIL
+            ok, buffer = cv2.imencode(
+                '.jpg',
+                cv2.cvtColor(region, cv2.COLOR_RGB2BGR),
+                [cv2.IMWRITE_JPEG_QUALITY, 85]
+            )
+            if not ok:
+                raise Exception("Failed to encode image as JPEG")
+            encoded_bytes = buffer.data
+        else:
+            img_byte_arr = io.BytesIO()
+            Image.fromarray(region).save(img_byte_arr, format='PNG')
+            encoded_bytes = img_byte_arr.getbuffer()
+        img_base64 = base64.b64encode(encoded_bytes).decode('ascii')
+        data_url = f"data:image/{image_format.lower()};base64,{img_base64}"
+        
+        if encode_cache is not None:
+            encode_cache[cache_key] = data_url
+        return data_url
+    
+    def _is_image_format_rejected(self, response, image_format):
+        """Check whether a failed request was rejected for its image format and should be retried with PNG input"""
+        if image_format == 'PNG' or response.status_code not in (400, 415, 422):
+            return False
+        if response.status_code == 415:
+            return True
+        # 400/422 also cover batch size and schema errors; only retry when the error names the image format
+        body = response.text.lower()
+        return any(term in body for term in ('unsupported media', 'unsupported image', 'image format', 'image type'))
+    
+    def _detect_objects(self, images, encode_cache=None):
+        """Detect page elements in a batch of images using NVIDIA YOLOX
+        
+        Returns one list of predictions per input image, in input order.
+        """
         headers = {
             "Authorization": f"Bearer {self.yolox_key}",
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
         
-        # Prepare payload according to NVIDIA API format
-        payload = {
-            "input": [{
-                "type": "image_url",
-                "url": f"data:image/png;base64,{img_base64}"
-            }]
-        }
-        
-        response = requests.post(
-            self.yolox_endpoint,
-            headers=headers,
-            json=payload  # Send as JSON instead of raw data
-        )
+        image_format = self.yolox_image_format
+        while True:
+            # Prepare payload according to NVIDIA API format (one entry per image)
+            payload = {
+                "input": [{
+                    "type": "image_url",
+                    "url": self._encode_image(image, image_format, encode_cache=encode_cache)
+                } for image in images]
+            }
+            
+            response = self.session.post(
+                self.yolox_endpoint,
+                headers=headers,
+                json=payload  # Send as JSON instead of raw data
+            )
+            
+            if not self._is_image_format_rejected(response, image_format):
+                break
+            print(f"YOLOX rejected {image_format} input, retrying as PNG")
+            image_format = 'PNG'
         
         if response.status_code == 200:
             result = response.json()
+            detections = result.get('results', [])
+            if len(detections) != len(images):
+                raise Exception(f"YOLOX API returned {len(detections)} results for {len(images)} images")
+            
             # Transform the response to match your expected format
-            predictions = []
-            for detection in result.get('results', []):
+            page_predictions = []
+            for detection in detections:
+                predictions = []
                 for box in detection.get('boxes', []):
                     predictions.append({
                         'label': box.get('label'),
                         'box': box.get('coordinates'),  # [x1, y1, x2, y2]
                         'confidence': box.get('confidence', 0.0)
                     })
-            return predictions
+                page_predictions.append(predictions)
+            return page_predictions
         else:
             raise Exception(f"YOLOX API request failed: {response.status_code} - {response.text}")
     
-    def _process_chart(self, image, bbox):
-        """Process chart using Google-DePlot"""
-        chart_img = image.crop(bbox)
-        img_byte_arr = io.BytesIO()
-        chart_img.save(img_byte_arr, format='PNG')
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode()
+    def _detect_batch(self, page_nums, images, encode_cache=None):
+        """Detect objects for a batch of pages, falling back to one request per page"""
+        if len(images) > 1:
+            try:
+                return self._detect_objects(images, encode_cache)
+            except Exception as e:
+                print(f"Batched YOLOX request failed for pages {page_nums[0]}-{page_nums[-1]}, "
+                      f"retrying one page at a time: {str(e)}")
+        
+        page_predictions = []
+        for page_num, image in zip(page_nums, images):
+            try:
+                page_predictions.append(self._detect_objects([image], encode_cache)[0])
+            except Exception as e:
+                print(f"Error processing page {page_num}: {str(e)}")
+                page_predictions.append([])
+        return page_predictions
+    
+    def _page_hash(self, image):
+        """Compute a 64-bit perceptual hash (sign of the low DCT frequencies) of a page image"""
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+        low_freq = cv2.dct(small)[:8, :8]
+        bits = np.packbits(low_freq.flatten() > np.median(low_freq))
+        return int.from_bytes(bits.tobytes(), 'big')
+    
+    def _page_thumbnail(self, image):
+        """Downscale a page to a 128x128 grayscale thumbnail for confirming near-duplicates"""
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        return cv2.resize(gray, (128, 128), interpolation=cv2.INTER_AREA)
+    
+    def _thumbnails_match(self, thumbnail, other):
+        """Check that two page thumbnails differ in at most 0.5% of their pixels"""
+        return np.count_nonzero(cv2.absdiff(thumbnail, other) > 16) <= thumbnail.size * 0.005
+    
+    def _find_source_page(self, image, page_num, unique_pages):
+        """Return the first earlier page that looks the same as this one (or page_num itself)
         
+        Pages with identical pixels are duplicates. With `duplicate_page_distance`
+        set, pages of the same size whose perceptual hashes differ in at most that
+        many bits are also duplicates, if their thumbnails match as well.
+        `unique_pages` holds the earlier pages that need detection; this page is
+        added if it is new.
+        """
+        digest = hashlib.blake2b(repr(image.shape).encode('ascii'), digest_size=16)
+        digest.update(np.ascontiguousarray(image).data)
+        digest = digest.digest()
+        
+        max_distance = self.duplicate_page_distance
+        page_hash = thumbnail = None
+        if max_distance is not None:
+            page_hash = self._page_hash(image)
+            thumbnail = self._page_thumbnail(image)
+        
+        for unique_digest, shape, unique_hash, unique_thumbnail, unique_page in unique_pages:
+            if unique_digest == digest:
+                return unique_page
+            if (page_hash is not None and shape == image.shape
+                    and bin(page_hash ^ unique_hash).count('1') <= max_distance
+                    and self._thumbnails_match(thumbnail, unique_thumbnail)):
+                return unique_page
+        unique_pages.append((digest, image.shape, page_hash, thumbnail, page_num))
+        return page_num
+    
+    def _filter_detections(self, objects):
+        """Select confident chart and table detections using vectorized masks
+        
+        Returns (charts, tables), each in detection order.
+        """
+        if not objects:
+            return [], []
+        
+        confidences = np.fromiter((obj['confidence'] for obj in objects), dtype=np.float32, count=len(objects))
+        labels = np.array([obj['label'] for obj in objects], dtype=object)
+        confident = confidences >= self.min_confidence  # Skip low confidence detections
+        
+        charts = [objects[i] for i in np.flatnonzero(confident & (labels == 'chart'))]
+        tables = [objects[i] for i in np.flatnonzero(confident & (labels == 'table'))]
+        return charts, tables
+    
+    def _process_chart(self, image, bbox, encode_cache=None):
+        """Process chart using Google-DePlot"""
         headers = {
             "Authorization": f"Bearer {self.deplot_key}",
             "Accept": "text/event-stream"
         }
         
-        payload = {
-            "messages": [{
-                "role": "user",
-                "content": f'Generate underlying data table of the figure below: <img src="data:image/png;base64,{img_base64}" />'
-            }],
-            "max_tokens": 1024,
-            "temperature": 0.20,
-            "top_p": 0.20,
-            "stream": True
-        }
-        
         try:
-            response = requests.post(
-                self.deplot_endpoint,
-                headers=headers,
-                json=payload
-            )
+            image_format = self.deplot_image_format
+            while True:
+                payload = {
+                    "messages": [{
+                        "role": "user",
+                        "content": f'Generate underlying data table of the figure below: <img src="{self._encode_image(image, image_format, bbox, encode_cache)}" />'
+                    }],
+                    "max_tokens": 1024,
+                    "temperature": 0.20,
+                    "top_p": 0.20,
+                    "stream": True
+                }
+                
+                response = self.session.post(
+                    self.deplot_endpoint,
+                    headers=headers,
+                    json=payload
+                )
+                
+                if not self._is_image_format_rejected(response, image_format):
+                    break
+                print(f"DePlot rejected {image_format} input, retrying as PNG")
+                image_format = 'PNG'
             response.raise_for_status()
             
-            # Process streaming response
-            chart_data = []
-            for line in response.iter_lines():
-                if line:
-                    chart_data.append(line.decode("utf-8"))
+            # Process streaming response: decode the buffered body once and
+            # drop empty lines (SSE event separators)
+            body = response.content.decode("utf-8")
+            chart_data = '\n'.join(line for line in body.splitlines() if line)
             
             return {
                 'bbox': bbox,
-                'data': '\n'.join(chart_data)
+                'data': chart_data
             }
         except Exception as e:
             raise Exception(f"DePlot API request failed: {str(e)}")
     
     def _process_table(self, image, bbox):
         """Process table region and return structured data"""
-        # Crop table region
-        table_img = image.crop(bbox)
+        # Crop table region; OCR works on PIL images
+        table_img = Image.fromarray(self._crop(image, bbox))
         return {
             'bbox': bbox,
             'image': table_img  # This will be processed by OCR later
         }
     
+    def _render_page(self, page):
+        """Render a PDF page as an RGB array (height x width x 3) for object detection
+        
+        Returns the pixmap and the array. The array wraps the pixmap's sample
+        memory without copying it, so the pixmap must be kept alive for as long
+        as the array is used.
+        """
+        pix = page.get_pixmap(matrix=self.page_matrix, alpha=False)
+        # samples_mv is a view of the pixmap buffer (samples would copy it); pages
+        # stay NumPy arrays internally and only crops handed to OCR become PIL images
+        return pix, np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+    
+    def _start_page_group(self, doc, start, executor, unique_pages, detections):
+        """Render a group of pages and submit YOLOX detection for its pages that aren't duplicates
+        
+        Returns (page_nums, pixmaps, images, source_pages, encode_cache) of the group.
+        """
+        page_nums = list(range(start, min(start + self.detection_batch_size, len(doc))))
+        pixmaps, images = zip(*(self._render_page(doc[page_num]) for page_num in page_nums))
+        
+        # Near-duplicate pages (covers, disclaimers, repeated boilerplate)
+        # reuse the detections of the first matching page instead of
+        # being sent to YOLOX again
+        source_pages = [
+            self._find_source_page(image, page_num, unique_pages)
+            for page_num, image in zip(page_nums, images)
+        ]
+        
+        # Base64 encodings of pages and regions, local to this group so concurrent
+        # calls on a shared extractor don't see each other's images (they are keyed
+        # by image id, which is only unique while the group's pages are alive)
+        encode_cache = {}
+        
+        unique = [i for i, (page_num, source) in enumerate(zip(page_nums, source_pages)) if source == page_num]
+        if unique:
+            future = executor.submit(
+                self._detect_batch, [page_nums[i] for i in unique], [images[i] for i in unique], encode_cache
+            )
+            for index, i in enumerate(unique):
+                detections[page_nums[i]] = (future, index)
+        return page_nums, pixmaps, images, source_pages, encode_cache
+    
+    def _collect_pages(self, doc, pages):
+        """Wait for the chart results of `pages` and yield the finished pages in order"""
+        for page_num, tables, chart_futures in pages:
+            # Collect chart data from DePlot
+            charts = []
+            for chart_future in chart_futures:
+                try:
+                    charts.append(chart_future.result())
+                except Exception as e:
+                    print(f"Error processing chart on page {page_num}: {str(e)}")
+            
+            yield {
+                'page_num': page_num,
+                'text': doc[page_num].get_text(),
+                'tables': tables,
+                'charts': charts
+            }
+    
+    def iter_pages(self, pdf_path):
+        """Extract content from PDF page by page, yielding each page as soon as it is done
+        
+        Yields dictionaries with 'page_num', 'text', 'tables' and 'charts' in page
+        order, so callers can start consuming early pages while later ones are
+        still being processed by the YOLOX/DePlot APIs.
+        """
+        doc = fitz.open(pdf_path)
+        
+        # Earlier pages that were sent to YOLOX: their digests and hashes, and their
+        # detections (future, index of the page in its batch)
+        unique_pages = []
+        detections = {}
+        
+        # Detection and chart extraction are network-bound, so run the API
+        # calls concurrently and collect the results in page order
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # Pages are rendered one group at a time as the pipeline reaches them.
+            # The next group is rendered and sent to YOLOX while the current one
+            # is processed, and charts of the current group overlap with collecting
+            # the previous one, so only about three groups of page images are held
+            next_group = self._start_page_group(doc, 0, executor, unique_pages, detections) if len(doc) else None
+            pending_pages, pending_pixmaps = [], ()
+            while next_group is not None:
+                page_nums, pixmaps, images, source_pages, encode_cache = next_group
+                next_start = page_nums[-1] + 1
+                next_group = (
+                    self._start_page_group(doc, next_start, executor, unique_pages, detections)
+                    if next_start < len(doc) else None
+                )
+                
+                pages = []
+                for page_num, image, source in zip(page_nums, images, source_pages):
+                    future, index = detections[source]
+                    objects = future.result()[index]
+                    tables = []
+                    chart_futures = []
+                    
+                    # Process each confident chart and table detection
+                    chart_objects, table_objects = self._filter_detections(objects)
+                    for obj in chart_objects:
+                        chart_futures.append(
+                            executor.submit(self._process_chart, image, obj['box'], encode_cache)
+                        )
+                    
+                    for obj in table_objects:
+                        try:
+                            tables.append(self._process_table(image, obj['box']))
+                        except Exception as e:
+                            print(f"Error processing table on page {page_num}: {str(e)}")
+                    
+                    pages.append((page_num, tables, chart_futures))
+                
+                # The previous group's pixmaps are released once its charts are collected
+                yield from self._collect_pages(doc, pending_pages)
+                pending_pages, pending_pixmaps = pages, pixmaps
+            
+            yield from self._collect_pages(doc, pending_pages)
+        finally:
+            # Don't start queued API calls if the caller stopped iterating early; waiting
+            # for running ones also keeps their pixmaps alive until they are done
+            executor.shutdown(wait=True, cancel_futures=True)
+            doc.close()
+    
     def extract_from_pdf(self, pdf_path):
         """Extract content from PDF including text, tables, and charts"""
-        doc = fitz.open(pdf_path)
         extracted_content = {
             'text': [],
             'tables': [],
             'charts': []
         }
         
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            
-            # Get page as image for object detection
-            pix = page.get_pixmap()
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            
-            try:
-                # Detect objects using YOLOX
-                objects = self._detect_objects(img)
-                
-                # Process each detected object
-                for obj in objects:
-                    if obj['confidence'] < 0.5:  # Skip low confidence detections
-                        continue
-                        
-                    if obj['label'] == 'chart':
-                        try:
-                            chart_data = self._process_chart(img, obj['box'])
-                            extracted_content['charts'].append(chart_data)
-                        except Exception as e:
-                            print(f"Error processing chart on page {page_num}: {str(e)}")
-                            
-                    elif obj['label'] == 'table':
-                        try:
-                            table_data = self._process_table(img, obj['box'])
-                            extracted_content['tables'].append(table_data)
-                        except Exception as e:
-                            print(f"Error processing table on page {page_num}: {str(e)}")
-            
-            except Exception as e:
-                print(f"Error processing page {page_num}: {str(e)}")
-            
-            # Extract text content
-            text = page.get_text()
+        for page in self.iter_pages(pdf_path):
             extracted_content['text'].append({
-                'page_num': page_num,
-                'content': text
+                'page_num': page['page_num'],
+                'content': page['text']
             })
+            extracted_content['tables'].extend(page['tables'])
+            extracted_content['charts'].extend(page['charts'])
             
-        return extracted_content 
\ No newline at end of file
+        return extracted_content
@@ -1,116 +1,256 @@
 import numpy as np
 from PIL import Image
-import requests
-import base64
+from utils.http_session import create_session
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import threading
+import itertools
+import hashlib
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
 import os
 import io
 
+try:
+    import orjson as _json  # Faster parsing of large OCR responses
+except ImportError:
+    import json as _json
+
 class OCRProcessor:
-    def __init__(self):
+    VECTORIZE_MIN_LINES = 32  # Below this the NumPy setup costs more than the Python loop
+    
+    def __init__(self, max_concurrency=5, use_cache=True, cache_size=256, max_image_edge=1600,
+                 max_table_edge=2048, use_multipart=None):
         self.api_key = os.getenv('NVIDIA_PADDLEOCR_KEY')
         self.paddleocr_endpoint = os.getenv('NVIDIA_PADDLEOCR_ENDPOINT')
+        self.max_concurrency = max_concurrency  # Max in-flight PaddleOCR requests
+        # Larger images are downscaled before upload (None disables); tables get
+        # a larger limit to keep small digits legible
+        self.max_image_edge = max_image_edge
+        self.max_table_edge = max_table_edge
+        self.session = create_session()  # Keep-alive connections reused across calls
         
-    def process_image(self, image):
-        """Extract text from image using NVIDIA PaddleOCR"""
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format='PNG')
-        img_base64 = base64.b64encode(img_byte_arr.getvalue()).decode()
+        # Upload raw PNG bytes as multipart/form-data instead of a base64 data URL,
+        # for endpoints that accept it (defaults to the OCR_USE_MULTIPART env var)
+        if use_multipart is None:
+            use_multipart = os.getenv('OCR_USE_MULTIPART', '0').lower() in ('1', 'true', 'yes')
+        self.use_multipart = use_multipart
         
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Accept": "application/json"
-        }
+        # LRU cache of OCR results keyed by image content, so repeated images
+        # (logos, headers, identical tables) skip the API call
+        self.use_cache = use_cache
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()  # process_* may run on worker threads
         
-        payload = {
-            "input": [{
-                "type": "image_url",
-                "url": f"data:image/png;base64,{img_base64}"
-            }]
-        }
+    def _cache_key(self, img_bytes):
+        """Key cached results on the encoded image bytes and the endpoint"""
+        if not self.use_cache:
+            return None
+        digest = hashlib.blake2b(img_bytes, digest_size=16)
+        digest.update(str(self.paddleocr_endpoint).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _cache_get(self, cache_key, kind):
+        """Get a cached 'raw' response or parsed 'text'/'table' result, or None"""
+        if cache_key is None:
+            return None
+        with self._cache_lock:
+            value = self._cache.get((cache_key, kind))
+            if value is not None:
+                self._cache.move_to_end((cache_key, kind))
+            return value
+    
+    def _cache_put(self, cache_key, kind, value):
+        """Store a result, evicting the least recently used entries"""
+        if cache_key is None:
+            return
+        with self._cache_lock:
+            self._cache[(cache_key, kind)] = value
+            self._cache.move_to_end((cache_key, kind))
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+    
+    def _encode_image(self, image, max_edge):
+        """Encode an image as PNG, reusing the bytes if this image was already encoded"""
+        # Remember encodings on the image itself so process_image and
+        # process_table on the same image only run the PNG encoder once
+        cached = getattr(image, '_cached_ocr_png', None)
+        if cached is not None and max_edge in cached:
+            return cached[max_edge]
         
+        img_bytes = self._encode_png(self._prepare_image(image, max_edge))
         try:
-            response = requests.post(
-                self.paddleocr_endpoint,
-                headers=headers,
-                json=payload
-            )
-            response.raise_for_status()
-            result = response.json()
-            return self._extract_text_from_response(result)
-        except Exception as e:
-            raise Exception(f"OCR API request failed: {str(e)}")
+            if cached is None:
+                cached = image._cached_ocr_png = {}
+            cached[max_edge] = img_bytes
+        except AttributeError:
+            pass  # Image type that doesn't accept attributes; just don't reuse
+        return img_bytes
     
-    def process_table(self, table_image):
-        """Special processing for table images using NVIDIA PaddleOCR"""
-        # Convert image to base64
+    def _prepare_image(self, image, max_edge):
+        """Downscale an image with Lanczos so its longest edge is at most max_edge"""
+        width, height = image.size
+        longest = max(width, height)
+        if not max_edge or longest <= max_edge:
+            return image
+        scale = max_edge / longest
+        return image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.LANCZOS)
+    
+    def _encode_png(self, image):
+        """Encode an image as PNG"""
+        # Fast zlib level keeps the image lossless for OCR at a fraction of the CPU cost;
+        # the buffer view avoids copying the encoded bytes
         img_byte_arr = io.BytesIO()
-        table_image.save(img_byte_arr, format='PNG')
-        image_b64 = base64.b64encode(img_byte_arr.getvalue()).decode()
-        
+        image.save(img_byte_arr, format='PNG', compress_level=1)
+        return img_byte_arr.getbuffer()
+    
+    def _post_image(self, img_bytes):
+        """Send an encoded image to NVIDIA PaddleOCR and return the HTTP response"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Accept": "application/json"
         }
         
+        if self.use_multipart:
+            files = {"image": ("image.png", bytes(img_bytes), "image/png")}
+            return self.session.post(
+                self.paddleocr_endpoint,
+                headers=headers,
+                files=files
+            )
+        
+        img_base64 = base64.b64encode(img_bytes).decode('ascii')
         payload = {
             "input": [{
                 "type": "image_url",
-                "url": f"data:image/png;base64,{image_b64}"
+                "url": f"data:image/png;base64,{img_base64}"
             }]
         }
         
-        response = requests.post(
+        return self.session.post(
             self.paddleocr_endpoint,
             headers=headers,
             json=payload
         )
+    
+    def process_image(self, image):
+        """Extract text from image using NVIDIA PaddleOCR"""
+        img_bytes = self._encode_image(image, self.max_image_edge)
+        cache_key = self._cache_key(img_bytes)
+        text = self._cache_get(cache_key, 'text')
+        if text is not None:
+            return text
+        
+        try:
+            # The raw response may already be cached by process_table
+            result = self._cache_get(cache_key, 'raw')
+            if result is None:
+                response = self._post_image(img_bytes)
+                response.raise_for_status()
+                result = _json.loads(response.content)
+                self._cache_put(cache_key, 'raw', result)
+            text = self._extract_text_from_response(result)
+        except Exception as e:
+            raise Exception(f"OCR API request failed: {str(e)}")
         
-        if response.status_code == 200:
-            result = response.json()
-            # Convert OCR results to structured table format
-            table_data = self._structure_table_data(result)
+        self._cache_put(cache_key, 'text', text)
+        return text
+    
+    def process_table(self, table_image):
+        """Special processing for table images using NVIDIA PaddleOCR"""
+        img_bytes = self._encode_image(table_image, self.max_table_edge)
+        cache_key = self._cache_key(img_bytes)
+        table_data = self._cache_get(cache_key, 'table')
+        if table_data is not None:
             return table_data
-        else:
-            raise Exception(f"PaddleOCR API request failed: {response.text}")
+        
+        # The raw response may already be cached by process_image
+        result = self._cache_get(cache_key, 'raw')
+        if result is None:
+            response = self._post_image(img_bytes)
+            if response.status_code != 200:
+                raise Exception(f"PaddleOCR API request failed: {response.text}")
+            result = _json.loads(response.content)
+            self._cache_put(cache_key, 'raw', result)
+        
+        # Convert OCR results to structured table format
+        table_data = self._structure_table_data(result)
+        self._cache_put(cache_key, 'table', table_data)
+        return table_data
+    
+    def process_images(self, images):
+        """Extract text from several images concurrently, returned in input order"""
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(self.process_image, images))
+    
+    def process_tables(self, table_images):
+        """Process several table images concurrently, returned in input order"""
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(self.process_table, table_images))
     
     def _extract_text_from_response(self, response):
         """Extract text from PaddleOCR response"""
-        text_blocks = []
-        for result in response.get('results', []):
-            for text_line in result.get('text_lines', []):
-                text_blocks.append(text_line.get('text', ''))
-        return '\n'.join(text_blocks)
+        return '\n'.join([
+            text_line.get('text', '')
+            for result in response.get('results', ())
+            for text_line in result.get('text_lines', ())
+        ])
     
     def _structure_table_data(self, response):
         """Convert NVIDIA PaddleOCR response to structured table format"""
         try:
-            # Get all text lines with their positions
-            text_lines = []
-            for result in response.get('results', []):
-                for text_line in result.get('text_lines', []):
-                    text = text_line.get('text', '')
-                    box = text_line.get('box', [])
-                    if box and text:
-                        # Calculate average y-coordinate for the text line
-                        y_coord = sum(point[1] for point in box) / len(box)
-                        x_coord = box[0][0]  # Use left-most x-coordinate
-                        text_lines.append((text, x_coord, y_coord))
+            # Get all text lines with their boxes
+            lines = [
+                (text_line.get('text', ''), text_line.get('box', ()))
+                for result in response.get('results', ())
+                for text_line in result.get('text_lines', ())
+            ]
+            lines = [(text, box) for text, box in lines if box and text]
+            texts = [text for text, _ in lines]
+            boxes = [box for _, box in lines]
+            
+            if len(boxes) > self.VECTORIZE_MIN_LINES:
+                try:
+                    return self._structure_boxes_vectorized(texts, boxes)
+                except ValueError:
+                    pass  # Boxes with differing point counts; use the loop below
             
-            # Group text lines by similar y-coordinates (within 10 pixels)
-            rows = {}
-            for text, x_coord, y_coord in text_lines:
-                row_key = int(y_coord / 10)
-                if row_key not in rows:
-                    rows[row_key] = []
-                rows[row_key].append((x_coord, text))
+            text_lines = []
+            for text, box in zip(texts, boxes):
+                # Calculate average y-coordinate for the text line, grouped
+                # into rows of similar y-coordinates (within 10 pixels)
+                y_coord = sum(point[1] for point in box) / len(box)
+                x_coord = box[0][0]  # Use left-most x-coordinate
+                text_lines.append((int(y_coord / 10), x_coord, text))
             
-            # Sort rows by y-coordinate and sort cells within each row by x-coordinate
-            structured_data = []
-            for row_key in sorted(rows.keys()):
-                row = sorted(rows[row_key], key=lambda x: x[0])  # Sort by x-coordinate
-                structured_data.append([cell[1] for cell in row])  # Extract just the text
+            # One sort by row, then by x-coordinate within each row
+            text_lines.sort(key=lambda line: (line[0], line[1]))
+            structured_data = [
+                [text for _, _, text in row]
+                for _, row in itertools.groupby(text_lines, key=lambda line: line[0])
+            ]
             
             return structured_data
             
         except Exception as e:
-            raise Exception(f"Error structuring table data: {e}") 
\ No newline at end of file
+            raise Exception(f"Error structuring table data: {e}")
+    
+    def _structure_boxes_vectorized(self, texts, boxes):
+        """Group text boxes into rows with NumPy, matching the loop in _structure_table_data"""
+        arr = np.asarray(boxes, dtype=np.float64)  # (N, points, 2); raises ValueError if ragged
+        ys = arr[:, :, 1].mean(axis=1)
+        xs = arr[:, 0, 0]
+        row_keys = np.trunc(ys / 10).astype(np.int64)
+        
+        # One stable sort by row, then by x within the row
+        order = np.lexsort((xs, row_keys))
+        sorted_keys = row_keys[order]
+        
+        # Split the sorted texts wherever the row key changes. Slicing plain
+        # lists avoids creating one small array per row with np.split
+        boundaries = [0, *(np.flatnonzero(np.diff(sorted_keys)) + 1).tolist(), len(order)]
+        sorted_texts = [texts[i] for i in order.tolist()]
+        return [sorted_texts[start:end] for start, end in zip(boundaries, boundaries[1:])]
\ No newline at end of file
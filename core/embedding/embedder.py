@@ -1,18 +1,56 @@
 from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 import os
+import functools
+import logging
 import tiktoken
 
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=None)
+def _get_encoder(name):
+    """Load a tiktoken encoding once per process and share it between embedders"""
+    return tiktoken.get_encoding(name)
+
 class DocumentEmbedder:
-    def __init__(self):
+    def __init__(self, max_concurrency=8, per_request_budget=4096, max_batch_size=64, tokenizer_threads=None):
         self.client = OpenAI(
             api_key=os.getenv('NVIDIA_EMBEDDING_KEY'),
             base_url=os.getenv('NVIDIA_EMBEDDING_ENDPOINT')
         )
+        self.model = "nvidia/nv-embedqa-e5-v5"
         self.max_tokens = 512  # Maximum tokens allowed by the API
         self.overlap = 50      # Token overlap between chunks
+        self.max_concurrency = max_concurrency  # Max in-flight embedding requests
+        self.per_request_budget = per_request_budget  # Max tokens packed into one request
+        self.max_batch_size = max_batch_size  # Max texts packed into one request
         # Initialize tokenizer - using cl100k_base which is used by many embedding models
-        self.tokenizer = tiktoken.get_encoding("cl100k_base")
+        self.tokenizer = _get_encoder("cl100k_base")
+        # tiktoken releases the GIL while encoding, so batch tokenization scales with cores
+        self.tokenizer_threads = tokenizer_threads or os.cpu_count() or 8
+        
+    def _truncate(self, text):
+        """Truncate text to max_tokens, returning the text and its token count"""
+        return self._truncate_batch([text])[0]
+    
+    def _truncate_batch(self, texts):
+        """Truncate texts to max_tokens, returning (text, token_count) pairs"""
+        # Encode the whole batch in one call; special tokens are treated as plain text
+        all_tokens = self.tokenizer.encode_ordinary_batch(texts, num_threads=self.tokenizer_threads)
+        results = [(text, len(tokens)) for text, tokens in zip(texts, all_tokens)]
+        
+        # Decode only the texts that exceed the limit
+        over_limit = [i for i, tokens in enumerate(all_tokens) if len(tokens) > self.max_tokens]
+        if over_limit:
+            truncated_texts = self.tokenizer.decode_batch(
+                [all_tokens[i][:self.max_tokens] for i in over_limit], num_threads=self.tokenizer_threads
+            )
+            for i, truncated_text in zip(over_limit, truncated_texts):
+                print(f"Text truncated from {len(all_tokens[i])} to {self.max_tokens} tokens")
+                results[i] = (truncated_text, self.max_tokens)
         
+        return results
+    
     def embed_text(self, text):
         """Generate embeddings using NVIDIA embedding model"""
         try:
@@ -20,70 +58,51 @@ class DocumentEmbedder:
                 raise ValueError("Input text must not be empty.")
                 
             # Check if text needs truncation
-            tokens = self.tokenizer.encode(text)
-            if len(tokens) > self.max_tokens:
-                # Truncate to max_tokens
-                truncated_tokens = tokens[:self.max_tokens]
-                truncated_text = self.tokenizer.decode(truncated_tokens)
-                print(f"Text truncated from {len(tokens)} to {len(truncated_tokens)} tokens")
-                
-                response = self.client.embeddings.create(
-                    input=[truncated_text],
-                    model="nvidia/nv-embedqa-e5-v5",
-                    encoding_format="float",
-                    extra_body={"input_type": "query", "truncate": "END"}
-                )
-            else:
-                response = self.client.embeddings.create(
-                    input=[text],
-                    model="nvidia/nv-embedqa-e5-v5",
-                    encoding_format="float",
-                    extra_body={"input_type": "query", "truncate": "END"}
-                )
-            return response.data[0].embedding
+            truncated_text, _ = self._truncate(text)
+            return self._embed_sub_batch([truncated_text])[0]
         except Exception as e:
             if hasattr(e, 'response') and e.response is not None:
                 print(f"Error response: {e.response.text}")
             raise Exception(f"Embedding API request failed: {str(e)}")
     
+    def _embed_sub_batch(self, batch_texts):
+        """Embed one request-sized batch of (already truncated) texts"""
+        response = self.client.embeddings.create(
+            input=batch_texts,
+            model=self.model,
+            encoding_format="float",
+            extra_body={"input_type": "query", "truncate": "END"}
+        )
+        return [data.embedding for data in response.data]
+    
     def embed_batch(self, texts):
         """Generate embeddings for a batch of texts"""
         try:
             if not texts or any(not text for text in texts):
                 raise ValueError("Input texts must not be empty.")
             
-            all_embeddings = []
-            # Process in smaller batches
-            batch_size = 5  # Reduced batch size
+            # Truncate any texts that exceed the token limit, keeping the
+            # token counts from that pass for packing
+            truncated = self._truncate_batch(texts)
             
-            for i in range(0, len(texts), batch_size):
-                batch_texts = texts[i:i + batch_size]
-                truncated_batch = []
-                
-                # Truncate any texts that exceed the token limit
-                for text in batch_texts:
-                    tokens = self.tokenizer.encode(text)
-                    if len(tokens) > self.max_tokens:
-                        # Truncate to max_tokens
-                        truncated_tokens = tokens[:self.max_tokens]
-                        truncated_text = self.tokenizer.decode(truncated_tokens)
-                        print(f"Text truncated from {len(tokens)} to {len(truncated_tokens)} tokens")
-                        truncated_batch.append(truncated_text)
-                    else:
-                        truncated_batch.append(text)
-                
-                # Print token counts for debugging
-                for idx, text in enumerate(truncated_batch):
-                    token_count = len(self.tokenizer.encode(text))
-                    print(f"Text {idx} token count: {token_count}")
-                
-                response = self.client.embeddings.create(
-                    input=truncated_batch,
-                    model="nvidia/nv-embedqa-e5-v5",
-                    encoding_format="float",
-                    extra_body={"input_type": "query", "truncate": "END"}
-                )
-                all_embeddings.extend([data.embedding for data in response.data])
+            # Greedily pack texts into requests by token budget
+            sub_batches = []
+            current, current_tokens = [], 0
+            for text, token_count in truncated:
+                if current and (current_tokens + token_count > self.per_request_budget
+                                or len(current) >= self.max_batch_size):
+                    sub_batches.append(current)
+                    current, current_tokens = [], 0
+                current.append(text)
+                current_tokens += token_count
+            sub_batches.append(current)
+            logger.debug("Packed %d texts into %d requests", len(texts), len(sub_batches))
+            
+            # Send the sub-batches concurrently; results come back in input order
+            all_embeddings = []
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                for embeddings in executor.map(self._embed_sub_batch, sub_batches):
+                    all_embeddings.extend(embeddings)
                 
             return all_embeddings
         except Exception as e:
@@ -93,26 +112,25 @@ class DocumentEmbedder:
     
     def count_tokens(self, text):
         """Count the number of tokens in the text using tiktoken"""
-        return len(self.tokenizer.encode(text))
+        return len(self.tokenizer.encode_ordinary(text))
     
     def chunk_text(self, text, chunk_size=None):
         """Split text into chunks with a specific token count"""
         if chunk_size is None:
             chunk_size = self.max_tokens
             
-        tokens = self.tokenizer.encode(text)
-        chunks = []
+        tokens = self.tokenizer.encode_ordinary(text)
+        if not tokens:
+            return []
         
-        # Create chunks with overlap
-        for i in range(0, len(tokens), chunk_size - self.overlap):
-            chunk_tokens = tokens[i:i + chunk_size]
-            chunk_text = self.tokenizer.decode(chunk_tokens)
-            chunks.append(chunk_text)
-            
-            # If we've processed all tokens, break
-            if i + chunk_size >= len(tokens):
-                break
-                
+        # Create chunks with overlap; the last chunk is the first one that
+        # reaches the end of the text
+        step = chunk_size - self.overlap
+        last_start = max(len(tokens) - chunk_size, 0)
+        slices = [tokens[i:i + chunk_size] for i in range(0, last_start + step, step)]
+        
+        # Decode all chunks in one call
+        chunks = self.tokenizer.decode_batch(slices, num_threads=self.tokenizer_threads)
         return chunks 
 
     def embed_batch_with_metadata(self, texts, metadata=None):
@@ -0,0 +1,84 @@
+import os
+import sqlite3
+import logging
+import hashlib
+import threading
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+class EmbeddingCache:
+    """Persistent SQLite cache of embeddings keyed by model and a hash of the text"""
+
+    # SQLite limits the number of bound parameters per statement
+    _LOOKUP_CHUNK = 500
+
+    def __init__(self, cache_dir=None):
+        """
+        Initialize the embedding cache
+
+        Args:
+            cache_dir: Directory for the cache database (defaults to ~/.cache/emissions_embeddings)
+        """
+        self.cache_dir = cache_dir or os.getenv(
+            'EMBEDDING_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'emissions_embeddings')
+        )
+        self.db_path = os.path.join(self.cache_dir, 'embeddings.sqlite')
+        self._lock = threading.Lock()  # One connection shared by worker threads
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(text: str) -> str:
+        """Hash a text segment"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get_many(self, model: str, keys: Sequence[str]) -> Dict[str, np.ndarray]:
+        """Return the cached float32 embeddings found for keys"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        try:
+            with self._lock:
+                for start in range(0, len(unique_keys), self._LOOKUP_CHUNK):
+                    chunk = unique_keys[start:start + self._LOOKUP_CHUNK]
+                    rows = self._conn.execute(
+                        "SELECT hash, vector FROM embedding_cache WHERE model = ? AND hash IN (%s)"
+                        % ",".join("?" * len(chunk)),
+                        (model, *chunk)
+                    ).fetchall()
+                    for key, vector in rows:
+                        found[key] = np.frombuffer(vector, dtype=np.float16).astype(np.float32)
+        except sqlite3.Error as e:
+            logger.warning("Error reading embedding cache: %s", e)
+        return found
+
+    def put_many(self, model: str, keys: Sequence[str], embeddings: List[Sequence[float]]):
+        """Store embeddings for keys as float16 bytes"""
+        rows = [
+            (model, key, np.asarray(embedding, dtype=np.float16).tobytes())
+            for key, embedding in zip(keys, embeddings)
+        ]
+        try:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO embedding_cache (model, hash, vector) VALUES (?, ?, ?)", rows
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Error writing embedding cache: %s", e)
+
+def open_embedding_cache(cache_dir=None) -> Optional[EmbeddingCache]:
+    """Open the embedding cache, or return None (caching disabled) if it can't be created"""
+    try:
+        return EmbeddingCache(cache_dir)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("Embedding cache unavailable, continuing without it: %s", e)
+        return None
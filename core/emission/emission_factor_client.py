@@ -1,21 +1,38 @@
 import requests
 import os
 from typing import List, Dict, Any
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
 import json
-from ..embedding.embedder import DocumentEmbedder
+import copy
+from utils.http_session import create_session
+
+# Search results shared by all clients in the process, keyed on the API URL,
+# normalized query and top_k. Emission factor data is effectively static, so
+# entries live for a day; fallback results are never cached.
+_RESULTS_CACHE = OrderedDict()
+_RESULTS_CACHE_LOCK = threading.Lock()
+_RESULTS_CACHE_SIZE = 4096
+_RESULTS_CACHE_TTL = 24 * 60 * 60  # seconds
 
 class EmissionFactorClient:
     """Client for accessing emission factor data through the Emission Factors API"""
     
-    def __init__(self, api_url=None):
+    def __init__(self, api_url=None, max_concurrency=16):
         """
         Initialize the emission factor client
         
         Args:
             api_url: The URL of the emission factors API (defaults to environment variable)
+            max_concurrency: Maximum number of concurrent API requests in search_many
         """
         self.api_url = api_url or os.getenv('EMISSION_FACTORS_API_URL', "http://localhost:8000/api/v1/emission-factors/search")
-        self.embedder = DocumentEmbedder()  # Use the existing document embedder
+        # Pooled keep-alive session; connection errors and timeouts are not
+        # retried so an unavailable API falls back to the built-in factors immediately
+        self.max_concurrency = max_concurrency
+        self.session = create_session(pool_maxsize=max_concurrency, connect_retries=0, read_retries=0)
         self.fallback_factors = self._load_fallback_factors()
         
     def _load_fallback_factors(self):
@@ -74,6 +91,12 @@ class EmissionFactorClient:
         Returns:
             Dictionary with search results
         """
+        cache_key = (self.api_url, " ".join(query.lower().split()), top_k)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            print(f"Using cached emission factors for: {query}")
+            return cached
+        
         try:
             print(f"Searching emission factors for: {query}")
             # Prepare the request payload
@@ -83,7 +106,7 @@ class EmissionFactorClient:
             }
             
             # Make the API request with timeout
-            response = requests.post(
+            response = self.session.post(
                 self.api_url,
                 headers={"Content-Type": "application/json"},
                 json=payload,
@@ -96,6 +119,7 @@ class EmissionFactorClient:
             # Parse and return the response
             result = response.json()
             print(f"Found {len(result.get('results', []))} emission factors")
+            self._cache_put(cache_key, result)
             return result
             
         except requests.RequestException as e:
@@ -112,28 +136,72 @@ class EmissionFactorClient:
                 
             raise Exception(f"Failed to search emission factors: {str(e)}")
             
-    def _get_fallback_results(self, query: str) -> Dict[str, Any]:
-        """Provide fallback emission factors when API is unavailable"""
-        lower_query = query.lower()
-        results = []
+    def search_many(self, queries: List[str], top_k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Search emission factors for several queries concurrently
+        
+        Args:
+            queries: The search queries
+            top_k: Maximum number of results to return per query
+            
+        Returns:
+            List of search results, in the same order as the queries
+        """
+        if not queries:
+            return []
         
-        # Match keywords in query to fallback factors
-        if "electricity" in lower_query:
-            results.append(self.fallback_factors["electricity"])
-        elif "gas" in lower_query:
-            results.append(self.fallback_factors["natural_gas"])
-        elif "fuel" in lower_query or "oil" in lower_query:
-            results.append(self.fallback_factors["fuel_oil"])
-        elif "gasoline" in lower_query or "petrol" in lower_query:
-            results.append(self.fallback_factors["vehicle_gasoline"])
-        elif "diesel" in lower_query:
-            results.append(self.fallback_factors["vehicle_diesel"])
-        elif "air" in lower_query or "flight" in lower_query or "plane" in lower_query:
-            results.append(self.fallback_factors["air_travel_medium"])
-        else:
-            # Default to electricity as it's commonly needed
-            results.append(self.fallback_factors["electricity"])
+        # Requests share the pooled keep-alive session, so concurrent lookups
+        # reuse open connections instead of each opening a new one
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(queries))) as executor:
+            return list(executor.map(lambda query: self.search_emission_factors(query, top_k), queries))
+    
+    def _cache_get(self, cache_key):
+        """Get a copy of unexpired cached search results, or None"""
+        with _RESULTS_CACHE_LOCK:
+            entry = _RESULTS_CACHE.get(cache_key)
+            if entry is None:
+                return None
+            stored_at, result = entry
+            if time.monotonic() - stored_at > _RESULTS_CACHE_TTL:
+                del _RESULTS_CACHE[cache_key]
+                return None
+            _RESULTS_CACHE.move_to_end(cache_key)
+        # Copied so callers (and the activities the factors are attached to) can't modify the cache
+        return copy.deepcopy(result)
+    
+    def _cache_put(self, cache_key, result):
+        """Store a copy of search results, evicting the least recently used entries"""
+        result = copy.deepcopy(result)
+        with _RESULTS_CACHE_LOCK:
+            _RESULTS_CACHE[cache_key] = (time.monotonic(), result)
+            _RESULTS_CACHE.move_to_end(cache_key)
+            while len(_RESULTS_CACHE) > _RESULTS_CACHE_SIZE:
+                _RESULTS_CACHE.popitem(last=False)
             
+    # Keyword -> fallback factor table, checked in order (first match wins).
+    # "gasoline" is listed before "gas" so it isn't matched as natural gas
+    _FALLBACK_KEYWORDS = (
+        (("electricity",), "electricity"),
+        (("gasoline", "petrol"), "vehicle_gasoline"),
+        (("gas",), "natural_gas"),
+        (("fuel", "oil"), "fuel_oil"),
+        (("diesel",), "vehicle_diesel"),
+        (("air", "flight", "plane"), "air_travel_medium"),
+    )
+    
+    def _match_fallback_factor(self, text: str) -> Dict[str, Any]:
+        """Pick the fallback emission factor whose keywords appear in the text"""
+        lower_text = text.lower()
+        for keywords, factor_key in self._FALLBACK_KEYWORDS:
+            if any(keyword in lower_text for keyword in keywords):
+                return dict(self.fallback_factors[factor_key])
+        
+        # Default to electricity as it's commonly needed
+        return dict(self.fallback_factors["electricity"])
+    
+    def _get_fallback_results(self, query: str) -> Dict[str, Any]:
+        """Provide fallback emission factors when API is unavailable"""
+        results = [self._match_fallback_factor(query)]
         print(f"Using fallback emission factor: {results[0]['description']}")
         return {"results": results}
             
@@ -168,14 +236,8 @@ class EmissionFactorClient:
             if not search_results or 'results' not in search_results or not search_results['results']:
                 print(f"No emission factors found for activity: {activity_description}")
                 
-                # Use a fallback if available
-                activity_lower = activity_description.lower()
-                if "electricity" in activity_lower:
-                    return self.fallback_factors["electricity"]
-                elif "gas" in activity_lower:
-                    return self.fallback_factors["natural_gas"]
-                
-                raise ValueError(f"No emission factors found for activity: {activity_description}")
+                # Use the matching fallback factor
+                return self._match_fallback_factor(activity_description)
             
             # Return the top result
             return search_results['results'][0]
@@ -183,4 +245,4 @@ class EmissionFactorClient:
         except Exception as e:
             print(f"Error getting emission factor, using fallback: {str(e)}")
             # Use a generic electricity factor as fallback
-            return self.fallback_factors["electricity"] 
\ No newline at end of file
+            return dict(self.fallback_factors["electricity"]) 
\ No newline at end of file
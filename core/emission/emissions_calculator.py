@@ -1,7 +1,160 @@
 import os
+import re
+import json
+import logging
 from typing import Dict, Any, List
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor
 from .emission_factor_client import EmissionFactorClient
+from ..llm.client import get_llm_pool, create_completion_hedged
+from ..llm._prompt_utils import format_docs
+from ..llm.context_budget import EMISSION_KEYWORDS
+from ..llm.response_cache import ResponseCache, open_response_cache
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+try:
+    # Faster parsing of LLM responses; orjson.JSONDecodeError subclasses json.JSONDecodeError
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# Patterns used to pull activities and figures out of LLM responses, compiled once
+_ACTIVITY_PATTERNS = [
+    re.compile(r'(?:Activity|Description):\s*(.*?)(?:\n|$)'),
+    re.compile(r'(\d+\.\s*.*?)(?:\n|$)'),
+    re.compile(r'- (.*?)(?:\n|$)')
+]
+_TOTAL_EMISSIONS_RE = re.compile(r'total.*emissions:?\s*(\d+\.?\d*)', re.IGNORECASE)
+_QUANTITY_RE = re.compile(r'(\d+\.?\d*)\s*(kwh|kw|mwh|therms|liters|gallons)')
+_NUMBER_RE = re.compile(r'(\d+\.?\d*)')
+
+# System prompts are module constants so every request sends a byte-identical
+# prefix, which lets the endpoint reuse its cached prefill for them.
+# Per-request content only ever goes in the user message.
+_ACTIVITY_SYSTEM_PROMPT = """You are an advanced carbon accounting AI designed to extract emission-relevant activities from documents. Your task is to identify all activities mentioned in the provided document that could generate greenhouse gas emissions, particularly focusing on:
+
+1. Utility bills (electricity, natural gas, water)
+2. Transportation (air travel, road transport, shipping)
+3. Energy consumption (electricity, fuel, heating)
+4. Material procurement and usage (paper, plastics, electronics)
+5. Waste generation and disposal
+6. Manufacturing processes
+7. Construction activities
+8. Agricultural activities
+9. Service provision
+
+For utility bills:
+- If you see an electricity bill, the electricity consumption is an emission-relevant activity
+- If you see a natural gas bill, the gas consumption is an emission-relevant activity
+- Even if only monetary amounts are shown, assume there is underlying energy consumption
+- Look for billing periods and total consumption amounts (kWh, therms, etc.)
+- If a specific consumption value isn't provided, note this in the details
+
+For each activity, extract:
+- A clear description of the activity
+- Quantities or amounts mentioned (if any)
+- Regions or locations (if mentioned)
+- Time periods (if relevant)
+- Any other details that would help calculate the emissions
+
+Respond in JSON format with a list of activities, like this:
+{
+  "activities": [
+    {
+      "description": "Electricity consumption",
+      "details": {
+        "quantity": "500 kWh",
+        "region": "California, USA",
+        "time_period": "January 2025",
+        "bill_amount": "$75.50"
+      }
+    },
+    {
+      "description": "Natural gas usage for heating",
+      "details": {
+        "quantity": "50 therms",
+        "region": "Northeast USA",
+        "time_period": "December 2024"
+      }
+    }
+  ]
+}
+
+IMPORTANT: For utility bills, if specific consumption values aren't provided but you can see it's an electricity or gas bill, still include it as an activity with whatever information is available. Make reasonable assumptions based on the document context."""
+
+_EMISSIONS_SYSTEM_PROMPT = """You are an advanced carbon accounting AI designed to calculate Scope 1, 2, and 3 greenhouse gas (GHG) emissions for any user-defined activity, product, or supply chain transaction. Your outputs align with the GHG Protocol, ISO 14064, and IPCC guidelines, using regionally and industry-specific emission factors from verified databases (e.g., EPA, DEFRA, Ecoinvent, IPCC 2023).
+
+Core Functionality:
+- *Process Identification*: Break down activities into emission-generating stages.
+- *Emission Factor Selection*: Prioritize region-specific, industry-specific, or global average emission factors.
+- *Calculation & Validation*: Compute emissions, validate against benchmarks, and highlight uncertainties.
+- *Output Requirements*: Return structured JSON with granular data and plain-language summaries.
+- **only calculate for transportation emission if you are provided with the details.
+- **always provide the units.
+- **dont give recommendations to cut down emission your outputs will be given to another model to guide the emission mitigation.
+
+Example Output Structure:
+
+{
+  "activity_description": "Purchase of 20 kg plastic bags (20 km transport)",
+  "emission_sources": [
+    {
+      "source": "production",
+      "processes": [
+        {
+          "name": "polyethylene_production",
+          "description": "Crude oil refining, polymerization, and bag manufacturing",
+          "parameters": {
+            "quantity": "20 kg",
+            "emission_factor": "1.5 kg CO2e/kg (IPCC 2023, Plastics Manufacturing)",
+            "calculation": "20 kg × 1.5 kg CO2e/kg = 30 kg CO2e",
+            "total_emissions": 30.0
+          }
+        },
+        {
+          "name": "raw_material_extraction",
+          "description": "Petroleum extraction and refining",
+          "parameters": {
+            "quantity": "20 kg",
+            "emission_factor": "0.115 kg CO2e/kg (Ecoinvent 2023, Crude Oil)",
+            "calculation": "20 kg × 0.115 kg CO2e/kg = 2.3 kg CO2e",
+            "total_emissions": 2.3
+          }
+        }
+      ],
+      "total_emissions": 32.3
+    },
+    {
+      "source": "transportation",
+      "processes": [
+        {
+          "name": "road_freight",
+          "description": "Round-trip diesel vehicle transport",
+          "parameters": {
+            "distance": "40 km (20 km × 2)",
+            "vehicle_type": "light-duty truck",
+            "emission_factor": "0.27 kg CO2e/km (EPA 2023)",
+            "calculation": "40 km × 0.27 kg CO2e/km = 10.8 kg CO2e",
+            "total_emissions": 10.8
+          }
+        }
+      ],
+      "total_emissions": 10.8
+    }
+  ],
+  "total_scope_3_emissions": 43.1,
+  "assumptions": [
+    "Defaulted to landfill disposal (emission factor: 0.1 kg CO2e/kg).",
+    "Vehicle type inferred as light-duty truck (user did not specify)."
+  ],
+  "data_sources": [
+    "IPCC 2023: Plastics Production Emission Factors",
+    "EPA 2023: Transportation Emission Factors"
+  ]
+}
+
+Use the emission factors provided when available, and make reasonable assumptions when needed. Be transparent about all assumptions made."""
 
 class EmissionsCalculator:
     """
@@ -9,19 +162,72 @@ class EmissionsCalculator:
     using DeepSeek-R1 LLM via NVIDIA NIMS
     """
     
-    def __init__(self, emission_factor_client=None):
+    def __init__(self, emission_factor_client=None, max_concurrency=4, use_cache=True, cache_dir=None,
+                 semantic_cache=None, hedge_after=None, max_context_tokens=6000, json_mode=True):
         """
         Initialize the emissions calculator
         
         Args:
             emission_factor_client: Optional client for emission factor lookup
+            max_concurrency: Maximum number of concurrent LLM calls in the batch methods
+            use_cache: Whether to reuse LLM responses for identical requests across runs
+            cache_dir: Directory for the on-disk response cache
+            semantic_cache: Optional SemanticCache to reuse activity extractions for near-duplicate documents
+            hedge_after: Seconds after which a slow LLM call is duplicated (None disables hedging,
+                which otherwise can double spend on slow calls)
+            max_context_tokens: Token budget for document content in the activity extraction prompt
+            json_mode: Ask the endpoint for a JSON object response (response_format=json_object)
         """
-        self.client = OpenAI(
-            base_url=os.getenv('NVIDIA_LLM_ENDPOINT'),
-            api_key=os.getenv('NVIDIA_LLM_KEY')
-        )
+        self.client = get_llm_pool()  # Shared pooled client or multi-endpoint pool
         self.model = "deepseek-ai/deepseek-r1"
+        # Activity extraction is plain structured output, so it runs on a smaller, faster model
+        self.extraction_model = os.getenv('NVIDIA_EXTRACTION_MODEL', 'meta/llama-3.1-8b-instruct')
         self.emission_factor_client = emission_factor_client or EmissionFactorClient()
+        self.max_concurrency = max_concurrency
+        self.response_cache = open_response_cache(cache_dir) if use_cache else None
+        self.semantic_cache = semantic_cache
+        self.hedge_after = hedge_after
+        self.max_context_tokens = max_context_tokens
+        # JSON mode makes the server return a well-formed object, so the fence and
+        # text fallbacks are only a defensive path
+        self.response_format = {"type": "json_object"} if json_mode else None
+        
+    def _build_request(self, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the chat completion arguments, requesting JSON output when enabled"""
+        request = {"model": self.model, "messages": messages, **params}
+        if self.response_format is not None:
+            request.setdefault("response_format", self.response_format)
+        return request
+    
+    def _chat(self, messages: List[Dict[str, str]], use_semantic_cache=False, **params) -> str:
+        """Call the LLM and return the message content, reusing cached responses"""
+        request = self._build_request(messages, params)
+        cache_key = ResponseCache.make_key(request) if self.response_cache else None
+        
+        if cache_key:
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                logger.debug("Using cached LLM response")
+                return content
+        
+        # Near-duplicate prompts only match when everything but the user prompt is identical
+        use_semantic_cache = use_semantic_cache and self.semantic_cache is not None
+        if use_semantic_cache:
+            namespace = ResponseCache.make_key({**request, "messages": messages[:-1]})
+            content = self.semantic_cache.lookup(namespace, messages[-1]["content"])
+            if content is not None:
+                logger.debug("Using semantically cached LLM response")
+                return content
+        
+        completion = create_completion_hedged(self.client, self.hedge_after, **request)
+        content = completion.choices[0].message.content
+        
+        if content:
+            if cache_key:
+                self.response_cache.put(cache_key, content)
+            if use_semantic_cache:
+                self.semantic_cache.add(namespace, messages[-1]["content"], content)
+        return content
         
     def extract_activities(self, document_content: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """
@@ -33,92 +239,326 @@ class EmissionsCalculator:
         Returns:
             List of activity descriptions with details
         """
+        # Call the LLM to extract activities
+        try:
+            logger.info("Sending request to LLM for activity extraction")
+            activities_json = self._chat(
+                messages=self._activity_extraction_messages(document_content),
+                use_semantic_cache=True,
+                model=self.extraction_model,
+                **self.ACTIVITY_EXTRACTION_PARAMS
+            )
+            
+            logger.debug("Activity extraction response starts with: %.200s", activities_json)
+            return self._parse_activities_response(activities_json)
+                
+        except Exception as e:
+            logger.warning("Error extracting activities: %s", e)
+            return []
+    
+    def extract_activities_with_factors(self, document_content: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Extract activities and look up their emission factors while the LLM is still responding
+        
+        The activity extraction response is streamed, and each activity is sent
+        for emission factor lookup as soon as its JSON object is complete.
+        
+        Args:
+            document_content: List of document segments with text and metadata
+            
+        Returns:
+            List of activity descriptions with details and, where found, an 'emission_factor'
+        """
+        try:
+            logger.info("Streaming activity extraction from LLM")
+            pieces = []
+            lookups = []
+            
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                stream = self._stream_chat(
+                    messages=self._activity_extraction_messages(document_content),
+                    model=self.extraction_model,
+                    **self.ACTIVITY_EXTRACTION_PARAMS
+                )
+                for activity in self._iter_streamed_activities(stream, pieces):
+                    lookups.append((activity, executor.submit(self._lookup_emission_factor, activity)))
+                
+                activities = []
+                for activity, future in lookups:
+                    factor = future.result()
+                    if factor is not None:
+                        activity['emission_factor'] = factor
+                    activities.append(activity)
+            
+            if activities:
+                logger.info("Extracted %d activities from streamed response", len(activities))
+                return activities
+            
+            # Nothing recognisable was streamed; parse the complete response instead
+            # (factors are then looked up in calculate_emissions)
+            return self._parse_activities_response("".join(pieces))
+            
+        except Exception as e:
+            logger.warning("Error extracting activities: %s", e)
+            return []
+    
+    # Emission factor lookups are I/O bound, so they run more widely than LLM calls
+    FACTOR_LOOKUP_CONCURRENCY = 16
+    
+    # Output token cap for one batched emissions calculation
+    BATCH_MAX_TOKENS = 8192
+    
+    # Sampling parameters for the activity extraction call
+    ACTIVITY_EXTRACTION_PARAMS = {"temperature": 0.3, "top_p": 0.7, "max_tokens": 512}
+    
+    def _activity_extraction_messages(self, document_content: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Build the chat messages for activity extraction"""
         # Format the document content for the prompt
         formatted_content = self._format_document_content(document_content)
         
         # Create the prompt for activity extraction
         prompt = self._create_activity_extraction_prompt(formatted_content)
         
-        # Call the LLM to extract activities
+        return [
+            {"role": "system", "content": self._get_activity_extraction_system_prompt()},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def _parse_activities_response(self, activities_json: str) -> List[Dict[str, Any]]:
+        """Parse the activity extraction response into a list of activities"""
+        # Try to parse the JSON response
+        try:
+            activities = self._load_json_response(activities_json, fence_tag='json')
+            
+            if 'activities' not in activities:
+                logger.warning("Response doesn't contain 'activities' key. Raw response: %s", activities)
+                # Try to build a valid structure if possible
+                if isinstance(activities, list):
+                    return activities  # Assume it's a list of activities
+                else:
+                    return []  # No activities found
+            
+            activities_list = activities.get('activities', [])
+            logger.info("Extracted %d activities", len(activities_list))
+            return activities_list
+            
+        except json.JSONDecodeError as e:
+            logger.warning("Failed to parse activity extraction response as JSON, "
+                           "building activities from the text instead: %s", e)
+            
+            # Try to extract structured information from non-JSON response
+            activities = self._extract_activities_from_text(activities_json)
+            if activities:
+                logger.info("Extracted %d activities from text response", len(activities))
+                return activities
+            return []
+    
+    def _load_json_response(self, text: str, fence_tag: str = None):
+        """
+        Parse an LLM response as JSON, falling back to its first ``` code block
+        
+        Args:
+            text: The response text
+            fence_tag: Language tag the code block must carry (e.g. 'json'); when
+                None any block is used and an optional 'json' tag is skipped
+        """
+        # Well-formed responses parse directly without scanning for fences
         try:
-            print("Sending request to LLM for activity extraction...")
-            completion = self.client.chat.completions.create(
-                model=self.model,
+            return _json_loads(text)
+        except json.JSONDecodeError as e:
+            error = e
+        
+        # This helps when the LLM wraps JSON in markdown or adds extra text
+        fence = '```' + (fence_tag or '')
+        start = text.find(fence)
+        if start != -1:
+            start += len(fence)
+            if fence_tag is None and text.startswith('json', start):
+                start += len('json')
+            end = text.find('```', start)
+            if end != -1:
+                return _json_loads(text[start:end].strip())
+        raise error
+    
+    def _stream_chat(self, messages: List[Dict[str, str]], **params):
+        """Stream the LLM response as text pieces, replaying cached responses whole"""
+        request = self._build_request(messages, params)
+        cache_key = ResponseCache.make_key(request) if self.response_cache else None
+        
+        if cache_key:
+            content = self.response_cache.get(cache_key)
+            if content is not None:
+                logger.debug("Using cached LLM response")
+                yield content
+                return
+        
+        pieces = []
+        for chunk in self.client.chat.completions.create(**request, stream=True):
+            if chunk.choices and chunk.choices[0].delta.content:
+                pieces.append(chunk.choices[0].delta.content)
+                yield pieces[-1]
+        
+        # Only a fully consumed stream is cached
+        if cache_key and pieces:
+            self.response_cache.put(cache_key, "".join(pieces))
+    
+    def _iter_streamed_activities(self, stream, pieces: List[str]):
+        """
+        Yield activity objects from a streamed JSON response as soon as each one is complete
+        
+        Objects are taken from the "activities" array of the top-level object, or
+        from a bare top-level array. Any <think> reasoning block the model emits
+        first is skipped. Every streamed piece is also appended to pieces.
+        """
+        text = ""
+        pos = 0              # Next character to scan
+        started = False      # Past any leading reasoning block
+        in_string = False
+        escaped = False
+        containers = []      # Stack of open '{' / '[' characters
+        object_start = None  # Start of the activity object being read
+        
+        for piece in stream:
+            pieces.append(piece)
+            text += piece
+            
+            if not started:
+                stripped = text.lstrip()
+                if stripped.startswith("<think>"):
+                    think_end = text.find("</think>")
+                    if think_end == -1:
+                        continue
+                    pos = think_end + len("</think>")
+                elif "<think>".startswith(stripped):
+                    continue  # Could still be the start of a reasoning block
+                started = True
+            
+            while pos < len(text):
+                char = text[pos]
+                if in_string:
+                    if escaped:
+                        escaped = False
+                    elif char == "\\":
+                        escaped = True
+                    elif char == '"':
+                        in_string = False
+                elif char == '"':
+                    in_string = True
+                elif char in "{[":
+                    # Activities sit directly inside {"activities": [...]} or a bare [...]
+                    if char == "{" and containers in (["{", "["], ["["]):
+                        object_start = pos
+                    containers.append(char)
+                elif char in "}]" and containers:
+                    containers.pop()
+                    if char == "}" and object_start is not None and containers in (["{", "["], ["["]):
+                        try:
+                            activity = _json_loads(text[object_start:pos + 1])
+                        except json.JSONDecodeError:
+                            activity = None
+                        object_start = None
+                        if isinstance(activity, dict) and activity.get('description'):
+                            yield activity
+                pos += 1
+    
+    def _lookup_emission_factor(self, activity: Dict[str, Any]):
+        """Get the emission factor for an activity, or None if the lookup fails"""
+        try:
+            return self.emission_factor_client.get_appropriate_emission_factor(
+                activity['description'],
+                activity.get('details', {})
+            )
+        except Exception as e:
+            logger.warning("Error getting emission factor for activity '%s': %s", activity.get('description'), e)
+            return None
+    
+    def extract_activities_batch(self, documents: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]]]:
+        """
+        Extract activities from several documents with concurrent LLM calls
+        
+        Args:
+            documents: List of document contents, each as accepted by extract_activities
+            
+        Returns:
+            List of activity lists, in the same order as the documents
+        """
+        return self._map_concurrent(self.extract_activities, documents)
+    
+    def calculate_emissions_batch(self, activities_list: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """
+        Calculate emissions for several documents' activities in a single LLM call
+        
+        The activities of every document go into one prompt, so the long system
+        prompt is only processed once. Documents missing from the model's answer
+        are calculated individually.
+        
+        Args:
+            activities_list: List of activity lists, each as accepted by calculate_emissions
+            
+        Returns:
+            List of emission calculation results, in the same order as the inputs
+        """
+        if len(activities_list) <= 1:
+            return [self.calculate_emissions(activities) for activities in activities_list]
+        
+        # Fetch emission factors for every document's activities up front
+        documents = [self._attach_emission_factors(activities) for activities in activities_list]
+        results = [None] * len(documents)
+        
+        try:
+            logger.info("Sending request to LLM for emissions calculation of %d documents", len(documents))
+            emissions_json = self._chat(
                 messages=[
-                    {"role": "system", "content": self._get_activity_extraction_system_prompt()},
-                    {"role": "user", "content": prompt}
+                    {"role": "system", "content": self._get_emissions_calculation_system_prompt()},
+                    {"role": "user", "content": self._create_batch_emissions_calculation_prompt(documents)}
                 ],
                 temperature=0.3,
                 top_p=0.7,
-                max_tokens=1024
+                max_tokens=min(1500 * len(documents), self.BATCH_MAX_TOKENS)
             )
+            batch_results = self._load_json_response(emissions_json)
             
-            # Parse the response to get activities
-            activities_json = completion.choices[0].message.content
-            print("Received LLM response for activity extraction:")
-            print(f"Response starts with: {activities_json[:200]}...")
-            
-            # Try to parse the JSON response
-            try:
-                import json
-                import re
-                
-                # Try to extract JSON from the response if it's not valid JSON already
-                # This helps when the LLM wraps JSON in markdown or adds extra text
-                json_pattern = r'```json\s*([\s\S]*?)\s*```'
-                json_match = re.search(json_pattern, activities_json)
-                
-                if json_match:
-                    # Extract JSON from code block
-                    extracted_json = json_match.group(1).strip()
-                    activities = json.loads(extracted_json)
-                else:
-                    # Try to parse directly
-                    activities = json.loads(activities_json)
-                
-                if 'activities' not in activities:
-                    print("Response doesn't contain 'activities' key. Raw response:")
-                    print(activities)
-                    # Try to build a valid structure if possible
-                    if isinstance(activities, list):
-                        return activities  # Assume it's a list of activities
-                    else:
-                        return []  # No activities found
-                
-                activities_list = activities.get('activities', [])
-                print(f"Successfully extracted {len(activities_list)} activities")
-                return activities_list
-                
-            except json.JSONDecodeError as e:
-                print(f"Failed to parse activity extraction response as JSON: {e}")
-                print("Attempting to build activities from non-JSON response...")
-                
-                # Try to extract structured information from non-JSON response
-                activities = self._extract_activities_from_text(activities_json)
-                if activities:
-                    print(f"Extracted {len(activities)} activities from text response")
-                    return activities
-                return []
-                
+            # Demultiplex the per-document results by their 1-based doc_index
+            if isinstance(batch_results, dict):
+                batch_results = batch_results.get('documents', [batch_results])
+            for result in batch_results if isinstance(batch_results, list) else []:
+                if not isinstance(result, dict):
+                    continue
+                try:
+                    index = int(result.pop('doc_index')) - 1
+                except (KeyError, TypeError, ValueError):
+                    continue
+                if 0 <= index < len(results):
+                    results[index] = result
         except Exception as e:
-            print(f"Error extracting activities: {str(e)}")
+            logger.warning("Batched emissions calculation failed, calculating documents individually: %s", e)
+        
+        # Fall back to one call per document for anything the batch didn't cover
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            logger.info("Calculating emissions individually for %d documents", len(missing))
+            for i, result in zip(missing, self._map_concurrent(self.calculate_emissions,
+                                                                  [documents[i] for i in missing])):
+                results[i] = result
+        return results
+    
+    def _map_concurrent(self, func, items):
+        """Apply func to each item on a thread pool bounded by max_concurrency"""
+        if not items:
             return []
+        
+        # The LLM calls are network/decode bound, so threads overlap them
+        # while the sync OpenAI client waits on the socket
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as executor:
+            return list(executor.map(func, items))
     
     def _extract_activities_from_text(self, text):
         """Extract activities from non-JSON text response"""
-        import re
-        
         activities = []
         
         # Look for "Activity" or "Description" patterns
-        activity_patterns = [
-            r'(?:Activity|Description):\s*(.*?)(?:\n|$)',
-            r'(\d+\.\s*.*?)(?:\n|$)',
-            r'- (.*?)(?:\n|$)'
-        ]
-        
-        for pattern in activity_patterns:
-            matches = re.findall(pattern, text)
+        for pattern in _ACTIVITY_PATTERNS:
+            matches = pattern.findall(text)
             if matches:
                 for match in matches:
                     if len(match.strip()) > 5:  # Avoid very short matches
@@ -139,34 +579,15 @@ class EmissionsCalculator:
         Returns:
             Structured emission calculation results
         """
-        # Fetch emission factors for each activity
-        activities_with_factors = []
-        
-        for activity in activities:
-            try:
-                # Get appropriate emission factor for the activity
-                factor = self.emission_factor_client.get_appropriate_emission_factor(
-                    activity['description'],
-                    activity.get('details', {})
-                )
-                
-                # Add the emission factor to the activity
-                activity['emission_factor'] = factor
-                activities_with_factors.append(activity)
-                
-            except Exception as e:
-                print(f"Error getting emission factor for activity '{activity['description']}': {str(e)}")
-                # Still include the activity even without a factor
-                activities_with_factors.append(activity)
+        activities_with_factors = self._attach_emission_factors(activities)
         
         # Create the prompt for emissions calculation
         prompt = self._create_emissions_calculation_prompt(activities_with_factors)
         
         # Call the LLM to calculate emissions
         try:
-            print("Sending request to LLM for emissions calculation...")
-            completion = self.client.chat.completions.create(
-                model=self.model,
+            logger.info("Sending request to LLM for emissions calculation")
+            emissions_json = self._chat(
                 messages=[
                     {"role": "system", "content": self._get_emissions_calculation_system_prompt()},
                     {"role": "user", "content": prompt}
@@ -176,44 +597,40 @@ class EmissionsCalculator:
                 max_tokens=1500
             )
             
-            # Parse the LLM response
-            emissions_json = completion.choices[0].message.content
-            print("Received LLM response for emissions calculation:")
-            print(f"Response starts with: {emissions_json[:200]}...")
+            logger.debug("Emissions calculation response starts with: %.200s", emissions_json)
             
             # Try to parse the JSON response
             try:
-                import json
-                import re
-                
-                # Try to extract JSON from the response if it's not valid JSON already
-                # This helps when the LLM wraps JSON in markdown or adds extra text
-                json_pattern = r'```(?:json)?\s*([\s\S]*?)\s*```'
-                json_match = re.search(json_pattern, emissions_json)
+                emissions_results = self._load_json_response(emissions_json)
                 
-                if json_match:
-                    # Extract JSON from code block
-                    extracted_json = json_match.group(1).strip()
-                    print("Extracted JSON from markdown code block")
-                    emissions_results = json.loads(extracted_json)
-                else:
-                    # Try to parse directly
-                    emissions_results = json.loads(emissions_json)
-                
-                print("Successfully parsed emissions calculation result")
+                logger.info("Parsed emissions calculation result")
                 return emissions_results
                 
             except json.JSONDecodeError as e:
-                print(f"Failed to parse emissions calculation response as JSON: {e}")
-                print("Creating fallback emissions calculation response...")
+                logger.warning("Failed to parse emissions calculation response as JSON, "
+                               "creating fallback result: %s", e)
                 
                 # Create a simplified response with the raw text
                 return self._create_fallback_emissions_result(emissions_json, activities_with_factors)
                 
         except Exception as e:
-            print(f"Error calculating emissions: {str(e)}")
+            logger.warning("Error calculating emissions: %s", e)
             return {"error": f"Error calculating emissions: {str(e)}"}
             
+    def _attach_emission_factors(self, activities: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Look up emission factors concurrently for activities that don't have one yet"""
+        # Factors may already be attached by extract_activities_with_factors
+        missing = [activity for activity in activities if 'emission_factor' not in activity]
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(self.FACTOR_LOOKUP_CONCURRENCY, len(missing))) as executor:
+                for activity, factor in zip(missing, executor.map(self._lookup_emission_factor, missing)):
+                    if factor is not None:
+                        # Add the emission factor to the activity
+                        activity['emission_factor'] = factor
+        
+        # Still include activities even without a factor
+        return list(activities)
+    
     def _create_fallback_emissions_result(self, raw_text, activities_with_factors):
         """Create a fallback structured emissions result when JSON parsing fails"""
         # Build a simple structured response
@@ -224,8 +641,7 @@ class EmissionsCalculator:
         }
         
         # Extract total emissions from text if available
-        import re
-        total_match = re.search(r'total.*emissions:?\s*(\d+\.?\d*)', raw_text, re.IGNORECASE)
+        total_match = _TOTAL_EMISSIONS_RE.search(raw_text)
         if total_match:
             result["total_scope_3_emissions"] = float(total_match.group(1))
             
@@ -241,7 +657,7 @@ class EmissionsCalculator:
                     
                 # Try to extract a quantity from the text using regex
                 description = activity['description'].lower()
-                quantity_match = re.search(r'(\d+\.?\d*)\s*(kwh|kw|mwh|therms|liters|gallons)', description)
+                quantity_match = _QUANTITY_RE.search(description)
                 if quantity_match:
                     quantity = quantity_match.group(0)
                 
@@ -250,7 +666,7 @@ class EmissionsCalculator:
                 quantity_value = 1.0  # Default if we can't parse
                 
                 # Try to extract numeric value from quantity
-                quantity_numeric_match = re.search(r'(\d+\.?\d*)', str(quantity))
+                quantity_numeric_match = _NUMBER_RE.search(str(quantity))
                 if quantity_numeric_match:
                     try:
                         quantity_value = float(quantity_numeric_match.group(1))
@@ -288,22 +704,7 @@ class EmissionsCalculator:
     
     def _format_document_content(self, document_content: List[Dict[str, Any]]) -> str:
         """Format document content for the prompt"""
-        formatted_docs = []
-        
-        for i, doc in enumerate(document_content):
-            text = doc.get('text', '')
-            metadata = doc.get('metadata', {})
-            
-            # Format metadata for better context
-            meta_str = ""
-            if metadata:
-                source = metadata.get('document_path', 'Unknown source')
-                page = metadata.get('page_num', 'Unknown page')
-                meta_str = f"[Source: {source}, Page: {page}]"
-            
-            formatted_docs.append(f"Document {i+1} {meta_str}:\n{text}\n")
-        
-        return "\n".join(formatted_docs)
+        return format_docs(document_content, self.max_context_tokens, EMISSION_KEYWORDS)
     
     def _create_activity_extraction_prompt(self, document_content: str) -> str:
         """Create the prompt for activity extraction"""
@@ -326,14 +727,23 @@ Extract and list ALL activities that could generate greenhouse gas emissions in
     
     def _create_emissions_calculation_prompt(self, activities_with_factors: List[Dict[str, Any]]) -> str:
         """Create the prompt for emissions calculation"""
-        activities_str = ""
+        activities_str = self._format_activities(activities_with_factors)
+        
+        return f"""Please calculate the greenhouse gas emissions (Scope 1, 2, and 3) for the following activities:
+
+{activities_str}
+
+For each activity, break down the emission sources and processes, and provide detailed calculations. Return the results in a structured JSON format as described in your instructions."""
+    
+    def _format_activities(self, activities_with_factors: List[Dict[str, Any]]) -> str:
+        """Format activities and their emission factors for the calculation prompts"""
+        activity_parts = []
         
         for i, activity in enumerate(activities_with_factors):
             # Format the activity details
             details_str = ""
             if 'details' in activity:
-                for key, value in activity['details'].items():
-                    details_str += f"\n    {key}: {value}"
+                details_str = "".join(f"\n    {key}: {value}" for key, value in activity['details'].items())
             
             # Format the emission factor if available
             factor_str = ""
@@ -341,142 +751,33 @@ Extract and list ALL activities that could generate greenhouse gas emissions in
                 factor = activity['emission_factor']
                 factor_str = f"\nEmission Factor: {factor.get('description', 'Unknown')} - Value: {factor.get('value', 'Unknown')} {factor.get('unit', '')}"
             
-            activities_str += f"""Activity {i+1}: {activity['description']}
+            activity_parts.append(f"""Activity {i+1}: {activity['description']}
 Details:{details_str or ' None provided'}
 {factor_str}
 
-"""
+""")
         
-        return f"""Please calculate the greenhouse gas emissions (Scope 1, 2, and 3) for the following activities:
+        return "".join(activity_parts)
+    
+    def _create_batch_emissions_calculation_prompt(self, documents: List[List[Dict[str, Any]]]) -> str:
+        """Create the prompt for calculating emissions of several documents at once"""
+        document_parts = []
+        for i, activities_with_factors in enumerate(documents):
+            # Reuse the single-document activity listing for each document
+            activities_str = self._format_activities(activities_with_factors)
+            document_parts.append(f"Document {i+1} activities:\n\n{activities_str}")
+        documents_str = "".join(document_parts)
+        
+        return f"""Please calculate the greenhouse gas emissions (Scope 1, 2, and 3) for the activities of each of the following {len(documents)} documents separately:
 
-{activities_str}
+{documents_str}
 
-For each activity, break down the emission sources and processes, and provide detailed calculations. Return the results in a structured JSON format as described in your instructions."""
+For each activity, break down the emission sources and processes, and provide detailed calculations. Return a JSON object whose "documents" array holds one result per document, each in the structured JSON format described in your instructions plus a "doc_index" field holding the document number, like {{"documents": [{{"doc_index": 1, ...}}, {{"doc_index": 2, ...}}]}}."""
     
     def _get_activity_extraction_system_prompt(self) -> str:
         """Get the system prompt for activity extraction"""
-        return """You are an advanced carbon accounting AI designed to extract emission-relevant activities from documents. Your task is to identify all activities mentioned in the provided document that could generate greenhouse gas emissions, particularly focusing on:
-
-1. Utility bills (electricity, natural gas, water)
-2. Transportation (air travel, road transport, shipping)
-3. Energy consumption (electricity, fuel, heating)
-4. Material procurement and usage (paper, plastics, electronics)
-5. Waste generation and disposal
-6. Manufacturing processes
-7. Construction activities
-8. Agricultural activities
-9. Service provision
-
-For utility bills:
-- If you see an electricity bill, the electricity consumption is an emission-relevant activity
-- If you see a natural gas bill, the gas consumption is an emission-relevant activity
-- Even if only monetary amounts are shown, assume there is underlying energy consumption
-- Look for billing periods and total consumption amounts (kWh, therms, etc.)
-- If a specific consumption value isn't provided, note this in the details
-
-For each activity, extract:
-- A clear description of the activity
-- Quantities or amounts mentioned (if any)
-- Regions or locations (if mentioned)
-- Time periods (if relevant)
-- Any other details that would help calculate the emissions
-
-Respond in JSON format with a list of activities, like this:
-{
-  "activities": [
-    {
-      "description": "Electricity consumption",
-      "details": {
-        "quantity": "500 kWh",
-        "region": "California, USA",
-        "time_period": "January 2025",
-        "bill_amount": "$75.50"
-      }
-    },
-    {
-      "description": "Natural gas usage for heating",
-      "details": {
-        "quantity": "50 therms",
-        "region": "Northeast USA",
-        "time_period": "December 2024"
-      }
-    }
-  ]
-}
-
-IMPORTANT: For utility bills, if specific consumption values aren't provided but you can see it's an electricity or gas bill, still include it as an activity with whatever information is available. Make reasonable assumptions based on the document context."""
+        return _ACTIVITY_SYSTEM_PROMPT
     
     def _get_emissions_calculation_system_prompt(self) -> str:
         """Get the system prompt for emissions calculation"""
-        return """You are an advanced carbon accounting AI designed to calculate Scope 1, 2, and 3 greenhouse gas (GHG) emissions for any user-defined activity, product, or supply chain transaction. Your outputs align with the GHG Protocol, ISO 14064, and IPCC guidelines, using regionally and industry-specific emission factors from verified databases (e.g., EPA, DEFRA, Ecoinvent, IPCC 2023).
-
-Core Functionality:
-- *Process Identification*: Break down activities into emission-generating stages.
-- *Emission Factor Selection*: Prioritize region-specific, industry-specific, or global average emission factors.
-- *Calculation & Validation*: Compute emissions, validate against benchmarks, and highlight uncertainties.
-- *Output Requirements*: Return structured JSON with granular data and plain-language summaries.
-- **only calculate for transportation emission if you are provided with the details.
-- **always provide the units.
-- **dont give recommendations to cut down emission your outputs will be given to another model to guide the emission mitigation.
-
-Example Output Structure:
-
-{
-  "activity_description": "Purchase of 20 kg plastic bags (20 km transport)",
-  "emission_sources": [
-    {
-      "source": "production",
-      "processes": [
-        {
-          "name": "polyethylene_production",
-          "description": "Crude oil refining, polymerization, and bag manufacturing",
-          "parameters": {
-            "quantity": "20 kg",
-            "emission_factor": "1.5 kg CO2e/kg (IPCC 2023, Plastics Manufacturing)",
-            "calculation": "20 kg × 1.5 kg CO2e/kg = 30 kg CO2e",
-            "total_emissions": 30.0
-          }
-        },
-        {
-          "name": "raw_material_extraction",
-          "description": "Petroleum extraction and refining",
-          "parameters": {
-            "quantity": "20 kg",
-            "emission_factor": "0.115 kg CO2e/kg (Ecoinvent 2023, Crude Oil)",
-            "calculation": "20 kg × 0.115 kg CO2e/kg = 2.3 kg CO2e",
-            "total_emissions": 2.3
-          }
-        }
-      ],
-      "total_emissions": 32.3
-    },
-    {
-      "source": "transportation",
-      "processes": [
-        {
-          "name": "road_freight",
-          "description": "Round-trip diesel vehicle transport",
-          "parameters": {
-            "distance": "40 km (20 km × 2)",
-            "vehicle_type": "light-duty truck",
-            "emission_factor": "0.27 kg CO2e/km (EPA 2023)",
-            "calculation": "40 km × 0.27 kg CO2e/km = 10.8 kg CO2e",
-            "total_emissions": 10.8
-          }
-        }
-      ],
-      "total_emissions": 10.8
-    }
-  ],
-  "total_scope_3_emissions": 43.1,
-  "assumptions": [
-    "Defaulted to landfill disposal (emission factor: 0.1 kg CO2e/kg).",
-    "Vehicle type inferred as light-duty truck (user did not specify)."
-  ],
-  "data_sources": [
-    "IPCC 2023: Plastics Production Emission Factors",
-    "EPA 2023: Transportation Emission Factors"
-  ]
-}
-
-Use the emission factors provided when available, and make reasonable assumptions when needed. Be transparent about all assumptions made.""" 
\ No newline at end of file
+        return _EMISSIONS_SYSTEM_PROMPT 
\ No newline at end of file
@@ -0,0 +1,41 @@
+import io
+from typing import Any, Dict, List, Sequence
+from .context_budget import select_within_budget
+
+def format_docs(docs: List[Dict[str, Any]], max_tokens: int = None, keywords: Sequence[str] = ()) -> str:
+    """
+    Format document segments for an LLM prompt
+
+    Args:
+        docs: Document segments with text and metadata
+        max_tokens: Token budget for the segment texts (None keeps every segment)
+        keywords: Terms used to pick the most relevant segments when over budget
+
+    Returns:
+        The numbered segments, with a note of how many were left out
+    """
+    # Keep the prompt within the token budget, dropping the least relevant segments
+    docs, dropped = select_within_budget(docs, max_tokens, keywords)
+
+    buf = io.StringIO()
+    for i, doc in enumerate(docs):
+        text = doc.get('text', '')
+        metadata = doc.get('metadata', {})
+
+        # Format metadata for better context
+        meta_str = ""
+        if metadata:
+            source = metadata.get('document_path', 'Unknown source')
+            page = metadata.get('page_num', 'Unknown page')
+            meta_str = f"[Source: {source}, Page: {page}]"
+
+        if i:
+            buf.write("\n")
+        buf.write(f"Document {i+1} {meta_str}:\n{text}\n")
+
+    if dropped:
+        if docs:
+            buf.write("\n")
+        buf.write(f"[...truncated {dropped} segments...]")
+
+    return buf.getvalue()
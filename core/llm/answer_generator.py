@@ -1,38 +1,18 @@
-from openai import OpenAI
 import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any
+from .client import get_llm_pool
+from ._prompt_utils import format_docs
+from .response_cache import ResponseCache, open_response_cache
 
-class LLMAnswerGenerator:
-    def __init__(self):
-        """Initialize the LLM Answer Generator with DeepSeek-R1 model via NVIDIA NIMS"""
-        self.client = OpenAI(
-            base_url=os.getenv('NVIDIA_LLM_ENDPOINT'),
-            api_key=os.getenv('NVIDIA_LLM_KEY')
-        )
-        self.model = "deepseek-ai/deepseek-r1"
-        
-    def generate_answer(self, query: str, context: List[Dict[str, Any]], stream: bool = False) -> str:
-        """
-        Generate an answer to a query based on retrieved context documents
-        
-        Args:
-            query: The user's question
-            context: List of retrieved documents with text and metadata
-            stream: Whether to stream the response (for UI)
-            
-        Returns:
-            Generated answer as a string
-        """
-        # Format the context into a string
-        formatted_context = self._format_context(context)
-        
-        # Create the prompt with the query and context
-        prompt = self._create_prompt(query, formatted_context)
-        
-        print(f"Generating answer with DeepSeek-R1 for query: '{query[:50]}...'")
-        
-        # Define the system prompt for carbon accounting
-        system_prompt = """You are an advanced carbon accounting AI designed to calculate Scope 3 greenhouse gas (GHG) emissions for any user-defined activity, product, or supply chain transaction. Your outputs align with the GHG Protocol, ISO 14064, and IPCC guidelines, using regionally and industry-specific emission factors from verified databases (e.g., EPA, DEFRA, Ecoinvent, IPCC 2023).
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+# Kept as a module constant so every request sends a byte-identical prefix,
+# which lets the endpoint reuse its cached prefill; the question and context
+# only ever go in the user message
+_ANSWER_SYSTEM_PROMPT = """You are an advanced carbon accounting AI designed to calculate Scope 3 greenhouse gas (GHG) emissions for any user-defined activity, product, or supply chain transaction. Your outputs align with the GHG Protocol, ISO 14064, and IPCC guidelines, using regionally and industry-specific emission factors from verified databases (e.g., EPA, DEFRA, Ecoinvent, IPCC 2023).
 
 Core Functionality:
 - *Process Identification*: Break down activities into emission-generating stages.
@@ -107,20 +87,73 @@ User Interaction Guidelines:
 - Ask for missing parameters (e.g., "Specify transport mode: air, road, rail?").
 - Be transparent about uncertainties.
 - Scale to complex supply chains."""
+
+class LLMAnswerGenerator:
+    def __init__(self, max_concurrency=4, use_cache=True, cache_dir=None, semantic_cache=None,
+                 max_context_tokens=6000):
+        """Initialize the LLM Answer Generator with DeepSeek-R1 model via NVIDIA NIMS"""
+        self.client = get_llm_pool()  # Shared pooled client or multi-endpoint pool
+        self.model = "deepseek-ai/deepseek-r1"
+        self.max_concurrency = max_concurrency  # Max in-flight LLM calls in generate_answers
+        # On-disk cache of non-streamed answers for identical requests
+        self.response_cache = open_response_cache(cache_dir) if use_cache else None
+        # Optional SemanticCache that reuses answers for paraphrased questions
+        self.semantic_cache = semantic_cache
+        self.max_context_tokens = max_context_tokens  # Token budget for retrieved context in the prompt
+        
+    def generate_answer(self, query: str, context: List[Dict[str, Any]], stream: bool = False,
+                        use_semantic_cache: bool = True) -> str:
+        """
+        Generate an answer to a query based on retrieved context documents
+        
+        Args:
+            query: The user's question
+            context: List of retrieved documents with text and metadata
+            stream: Whether to stream the response (for UI)
+            use_semantic_cache: Whether to reuse answers for near-duplicate prompts, if a semantic cache is set
+            
+        Returns:
+            Generated answer as a string
+        """
+        # Format the context into a string
+        formatted_context = self._format_context(context)
+        
+        # Create the prompt with the query and context
+        prompt = self._create_prompt(query, formatted_context)
+        
+        logger.info("Generating answer with DeepSeek-R1 for query: '%.50s'", query)
+        
+        request = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": _ANSWER_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.3,  # Lower temperature for more factual responses
+            "top_p": 0.7,
+            "max_tokens": 1024
+        }
+        
+        # Streams are consumed by the UI, so only full answers are cached
+        cache_key = ResponseCache.make_key(request) if self.response_cache and not stream else None
+        if cache_key:
+            answer = self.response_cache.get(cache_key)
+            if answer is not None:
+                logger.debug("Using cached answer")
+                return answer
+        
+        # Near-duplicate prompts only match when the system prompt and parameters are identical
+        use_semantic_cache = use_semantic_cache and not stream and self.semantic_cache is not None
+        if use_semantic_cache:
+            namespace = ResponseCache.make_key({**request, "messages": request["messages"][:-1]})
+            answer = self.semantic_cache.lookup(namespace, prompt)
+            if answer is not None:
+                logger.debug("Using semantically cached answer")
+                return answer
         
         try:
             # Call the LLM
-            completion = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3,  # Lower temperature for more factual responses
-                top_p=0.7,
-                max_tokens=1024,
-                stream=stream
-            )
+            completion = self.client.chat.completions.create(**request, stream=stream)
             
             # Handle streaming or non-streaming response
             if stream:
@@ -128,30 +161,39 @@ User Interaction Guidelines:
             else:
                 # For non-streaming, collect the full response
                 answer = completion.choices[0].message.content
+                if answer:
+                    if cache_key:
+                        self.response_cache.put(cache_key, answer)
+                    if use_semantic_cache:
+                        self.semantic_cache.add(namespace, prompt, answer)
                 return answer
                 
         except Exception as e:
-            print(f"Error generating answer with LLM: {str(e)}")
+            logger.warning("Error generating answer with LLM: %s", e)
             return f"I encountered an error while generating an answer: {str(e)}"
     
-    def _format_context(self, context: List[Dict[str, Any]]) -> str:
-        """Format the retrieved documents into a string for the prompt"""
-        formatted_docs = []
+    def generate_answers(self, queries: List[str], contexts: List[List[Dict[str, Any]]]) -> List[str]:
+        """
+        Generate answers for several queries with concurrent LLM calls
         
-        for i, doc in enumerate(context):
-            text = doc.get('text', '')
-            metadata = doc.get('metadata', {})
-            
-            # Format metadata for better context
-            meta_str = ""
-            if metadata:
-                source = metadata.get('document_path', 'Unknown source')
-                page = metadata.get('page_num', 'Unknown page')
-                meta_str = f"[Source: {source}, Page: {page}]"
+        Args:
+            queries: The user's questions
+            contexts: Retrieved documents for each question
             
-            formatted_docs.append(f"Document {i+1} {meta_str}:\n{text}\n")
+        Returns:
+            List of generated answers, in the same order as the queries
+        """
+        if len(queries) != len(contexts):
+            raise ValueError("Number of contexts must match number of queries")
+        if not queries:
+            return []
         
-        return "\n".join(formatted_docs)
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(queries))) as executor:
+            return list(executor.map(self.generate_answer, queries, contexts))
+    
+    def _format_context(self, context: List[Dict[str, Any]]) -> str:
+        """Format the retrieved documents into a string for the prompt"""
+        return format_docs(context, self.max_context_tokens)
     
     def _create_prompt(self, query: str, context: str) -> str:
         """Create the prompt for the LLM"""
@@ -0,0 +1,247 @@
+import os
+import logging
+import functools
+import importlib.util
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import openai
+from openai import OpenAI
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+# Retries for rate limits (429, honouring retry-after), 408/409,
+# 5xx responses, timeouts and connection errors, with jittered exponential backoff
+LLM_MAX_RETRIES = 5
+
+@functools.lru_cache(maxsize=None)
+def get_llm_client(base_url=None, api_key=None):
+    """
+    Get the OpenAI client for the NVIDIA NIMS LLM endpoint, shared across the process
+
+    All LLM callers reuse one client so its keep-alive connection pool (and
+    TLS sessions) survive across calls and pipeline instances. HTTP/2 is used
+    when the `h2` package is installed, multiplexing concurrent calls over one
+    connection. Transient failures are retried by the SDK up to LLM_MAX_RETRIES
+    times, so one rate-limited or dropped call doesn't fail a whole batch.
+
+    Args:
+        base_url: The LLM endpoint (defaults to the NVIDIA_LLM_ENDPOINT environment variable)
+        api_key: The API key (defaults to the NVIDIA_LLM_KEY environment variable)
+    """
+    http_client = httpx.Client(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    )
+    return OpenAI(
+        base_url=base_url or os.getenv('NVIDIA_LLM_ENDPOINT'),
+        api_key=api_key or os.getenv('NVIDIA_LLM_KEY'),
+        http_client=http_client,
+        max_retries=LLM_MAX_RETRIES
+    )
+
+class _PooledStream:
+    """
+    A streamed chat completion that holds its endpoint slot until it is consumed
+    
+    The slot is released once the stream is exhausted, closed or garbage
+    collected, so the pool's concurrency limit also covers streams that are
+    still being read. Other attributes are passed through to the wrapped stream.
+    """
+    _released = True  # Until __init__ has run, so __del__ never releases a slot it doesn't hold
+    
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+        self._release_lock = threading.Lock()
+        self._released = False
+    
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+    
+    def close(self):
+        """Close the underlying stream and release the endpoint slot (once)"""
+        with self._release_lock:
+            if self._released:
+                return
+            self._released = True
+        try:
+            self._stream.close()
+        finally:
+            self._release()
+    
+    def __del__(self):
+        self.close()
+
+class LLMClientPool:
+    """
+    Spread chat completions over several LLM endpoints with failover
+    
+    Each call goes to the endpoint with the lowest share of its concurrency limit
+    in use. Server errors, timeouts and connection failures are retried on the
+    next endpoint; client errors (4xx) are raised immediately. The pool exposes
+    `chat.completions.create`, so it can be used wherever an OpenAI client is.
+    """
+    
+    def __init__(self, endpoints):
+        """
+        Initialize the pool
+        
+        Args:
+            endpoints: List of (base_url, api_key, max_concurrency) tuples
+        """
+        if not endpoints:
+            raise ValueError("At least one LLM endpoint is required")
+        self.endpoints = [
+            {
+                "url": url,
+                "client": get_llm_client(url, api_key),
+                "limit": concurrency,
+                "slots": threading.BoundedSemaphore(concurrency),
+                "in_flight": 0
+            }
+            for url, api_key, concurrency in endpoints
+        ]
+        self._lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+    
+    @classmethod
+    def from_env(cls, spec=None, default_concurrency=8):
+        """
+        Build a pool from NVIDIA_LLM_ENDPOINTS
+        
+        The variable holds comma-separated endpoints written as `url`, `key@url`
+        or `key@url#concurrency`; the key defaults to NVIDIA_LLM_KEY.
+        """
+        spec = spec if spec is not None else os.getenv('NVIDIA_LLM_ENDPOINTS', '')
+        endpoints = []
+        for entry in filter(None, (part.strip() for part in spec.split(','))):
+            entry, _, concurrency = entry.partition('#')
+            # Split the key off at the first '@' that comes before the URL scheme
+            api_key, at, url = entry.partition('@')
+            if not at or '://' in api_key:
+                api_key, url = None, entry
+            endpoints.append((url, api_key or os.getenv('NVIDIA_LLM_KEY'),
+                              int(concurrency) if concurrency else default_concurrency))
+        return cls(endpoints)
+    
+    def _ordered_endpoints(self, endpoints=None):
+        """Endpoints (all of them by default) ordered from least to most loaded"""
+        with self._lock:
+            return sorted(endpoints or self.endpoints, key=lambda endpoint: endpoint["in_flight"] / endpoint["limit"])
+    
+    def _acquire(self, endpoints):
+        """
+        Take a slot on one of the endpoints and return that endpoint
+        
+        Endpoints are tried without blocking in order of load, so a caller never
+        waits on an endpoint that filled up after it was picked while another
+        still has room; only when all are full does it wait on the least loaded.
+        """
+        ordered = self._ordered_endpoints(endpoints)
+        for endpoint in ordered:
+            if endpoint["slots"].acquire(blocking=False):
+                break
+        else:
+            endpoint = ordered[0]
+            endpoint["slots"].acquire()
+        with self._lock:
+            endpoint["in_flight"] += 1
+        return endpoint
+    
+    def _release(self, endpoint):
+        """Give back a slot taken on an endpoint"""
+        with self._lock:
+            endpoint["in_flight"] -= 1
+        endpoint["slots"].release()
+    
+    def create(self, **request):
+        """
+        Create a chat completion on the least loaded endpoint, failing over on server errors
+        
+        Streamed completions keep their endpoint slot until the stream is consumed
+        or closed, rather than only while the request is being opened.
+        """
+        last_error = None
+        remaining = list(self.endpoints)
+        while remaining:
+            # Each endpoint is tried at most once per call
+            endpoint = self._acquire(remaining)
+            remaining = [other for other in remaining if other is not endpoint]
+            try:
+                completion = endpoint["client"].chat.completions.create(**request)
+            except (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError) as e:
+                logger.warning("LLM endpoint %s failed, trying the next one: %s", endpoint['url'], e)
+                last_error = e
+                self._release(endpoint)
+                continue
+            except BaseException:
+                self._release(endpoint)
+                raise
+            
+            if request.get("stream"):
+                return _PooledStream(completion, functools.partial(self._release, endpoint))
+            self._release(endpoint)
+            return completion
+        raise last_error
+
+@functools.lru_cache(maxsize=None)
+def get_llm_pool():
+    """
+    Get the process-wide LLM client
+    
+    Returns an LLMClientPool when NVIDIA_LLM_ENDPOINTS lists endpoints, and the
+    single shared client for NVIDIA_LLM_ENDPOINT otherwise.
+    """
+    if os.getenv('NVIDIA_LLM_ENDPOINTS'):
+        return LLMClientPool.from_env()
+    return get_llm_client()
+
+def create_completion_hedged(client, hedge_after, **request):
+    """
+    Create a chat completion, sending a duplicate request if the first is slow
+
+    If the first request hasn't finished within hedge_after seconds an identical
+    second request is sent, and whichever succeeds first is returned. The
+    slower call can't be cancelled mid-request; its result is discarded.
+
+    Args:
+        client: The OpenAI client
+        hedge_after: Seconds to wait before hedging (None or 0 disables hedging)
+        **request: Arguments for chat.completions.create
+    """
+    if not hedge_after:
+        return client.chat.completions.create(**request)
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    try:
+        pending = {executor.submit(client.chat.completions.create, **request)}
+        done, pending = wait(pending, timeout=hedge_after)
+        if not done:
+            logger.info("LLM call still running after %ss, sending hedged request", hedge_after)
+            pending.add(executor.submit(client.chat.completions.create, **request))
+
+        # Return the first successful response; only fail once every attempt has failed
+        while True:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+            if not pending:
+                raise next(iter(done)).exception()
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,51 @@
+from typing import Any, Dict, List, Sequence, Tuple
+from ..embedding.embedder import _get_encoder
+
+# Terms that mark a segment as likely to describe an emission-relevant activity. They are
+# matched as substrings, so generic words that occur on almost any business page
+# ('total', 'usage', 'energy', 'meter', 'km', ...) are left out
+EMISSION_KEYWORDS = (
+    'kwh', 'mwh', 'gwh', 'therms', 'gallon', 'litre', 'liter', 'btu', 'diesel', 'gasoline',
+    'petrol', 'natural gas', 'propane', 'kerosene', 'lpg', 'fuel oil', 'jet fuel', 'electricity',
+    'refrigerant', 'freight', 'flight', 'vehicle miles', 'tonne-km', 'landfill', 'waste disposal'
+)
+
+def select_within_budget(segments: Sequence[Dict[str, Any]], max_tokens: int,
+                         keywords: Sequence[str] = ()) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Pick the segments to include in a prompt without exceeding a token budget
+
+    Segments are packed greedily, most relevant first, and returned in their
+    original order. With keywords, relevance is the number of keywords found
+    in a segment's text; without them the given order is treated as the
+    ranking (e.g. retrieval results).
+
+    Args:
+        segments: Document segments with a 'text' entry
+        max_tokens: Token budget for the segment texts (None disables the budget)
+        keywords: Lowercase terms used to score segments
+
+    Returns:
+        The kept segments and the number of segments left out
+    """
+    if not max_tokens or not segments:
+        return list(segments), 0
+
+    texts = [segment.get('text', '') for segment in segments]
+    token_counts = [len(tokens) for tokens in _get_encoder("cl100k_base").encode_ordinary_batch(texts)]
+    if sum(token_counts) <= max_tokens:
+        return list(segments), 0
+
+    order = range(len(segments))
+    if keywords:
+        scores = [sum(keyword in text.lower() for keyword in keywords) for text in texts]
+        order = sorted(order, key=lambda i: -scores[i])  # Stable, so ties keep document order
+
+    kept = set()
+    used = 0
+    for i in order:
+        if used + token_counts[i] <= max_tokens:
+            kept.add(i)
+            used += token_counts[i]
+
+    return [segment for i, segment in enumerate(segments) if i in kept], len(segments) - len(kept)
@@ -0,0 +1,80 @@
+import os
+import logging
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+class ResponseCache:
+    """Persistent SQLite cache of LLM completions keyed by a hash of the request"""
+
+    def __init__(self, cache_dir=None, ttl=30 * 24 * 60 * 60):
+        """
+        Initialize the response cache
+
+        Args:
+            cache_dir: Directory for the cache database (defaults to ~/.cache/emissions_llm)
+            ttl: Seconds before a cached completion expires (None keeps entries forever)
+        """
+        self.cache_dir = cache_dir or os.getenv(
+            'LLM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'emissions_llm')
+        )
+        self.ttl = ttl
+        self.db_path = os.path.join(self.cache_dir, 'responses.sqlite')
+        self._lock = threading.Lock()  # One connection shared by worker threads
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, content TEXT, created_at REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(request: Dict[str, Any]) -> str:
+        """Hash the model, messages and sampling parameters of a request"""
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached completion for a key, or None if missing or expired"""
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT content, created_at FROM cache WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Error reading LLM response cache: %s", e)
+            return None
+
+        if row is None:
+            return None
+        content, created_at = row
+        if self.ttl is not None and time.time() - created_at > self.ttl:
+            return None
+        return content
+
+    def put(self, key: str, content: str):
+        """Store a completion for a key"""
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, content, created_at) VALUES (?, ?, ?)",
+                    (key, content, time.time())
+                )
+                self._conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Error writing LLM response cache: %s", e)
+
+def open_response_cache(cache_dir=None) -> Optional[ResponseCache]:
+    """Open the response cache, or return None (caching disabled) if it can't be created"""
+    try:
+        return ResponseCache(cache_dir)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning("LLM response cache unavailable, continuing without it: %s", e)
+        return None
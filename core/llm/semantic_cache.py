@@ -0,0 +1,76 @@
+import threading
+from typing import Optional
+import numpy as np
+
+class SemanticCache:
+    """In-memory cache that reuses LLM responses for near-duplicate prompts"""
+
+    def __init__(self, threshold=0.95, max_entries=1024, model_name="all-MiniLM-L6-v2"):
+        """
+        Initialize the semantic cache
+
+        Args:
+            threshold: Minimum cosine similarity for a cached response to be reused
+            max_entries: Maximum number of cached prompts (oldest are dropped first)
+            model_name: sentence-transformers model used to embed prompts
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+        # Prompt embeddings are stored L2-normalized, so a dot product is the cosine similarity
+        self._namespaces = []
+        self._vectors = []
+        self._contents = []
+        self._matrix = None  # Stacked vectors, rebuilt lazily after changes
+
+    def _embed(self, text: str) -> np.ndarray:
+        """Embed a prompt as a normalized float32 vector"""
+        if self._model is None:
+            # Loaded under the lock so concurrent first lookups load the model only once
+            with self._lock:
+                if self._model is None:
+                    # Imported lazily so the model is only loaded when the cache is used
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, namespace: str, text: str) -> Optional[str]:
+        """
+        Find a cached response for a prompt similar to text
+
+        Args:
+            namespace: Exact-match key for everything except the prompt (model, system prompt, parameters)
+            text: The prompt to compare
+
+        Returns:
+            The cached response, or None if no prompt is similar enough
+        """
+        vector = self._embed(text)
+        with self._lock:
+            if not self._vectors:
+                return None
+            if self._matrix is None:
+                self._matrix = np.vstack(self._vectors)
+            scores = self._matrix @ vector
+
+            # Only compare against entries made with the same system prompt and parameters
+            for index in np.argsort(-scores):
+                if scores[index] < self.threshold:
+                    return None
+                if self._namespaces[index] == namespace:
+                    return self._contents[index]
+        return None
+
+    def add(self, namespace: str, text: str, content: str):
+        """Cache the response for a prompt"""
+        vector = self._embed(text)
+        with self._lock:
+            self._namespaces.append(namespace)
+            self._vectors.append(vector)
+            self._contents.append(content)
+            if len(self._vectors) > self.max_entries:
+                del self._namespaces[0], self._vectors[0], self._contents[0]
+            self._matrix = None
@@ -1,9 +1,25 @@
-from .ingestion_pipeline import IngestionPipeline
+from .ingestion_pipeline import IngestionPipeline, is_substantial_text
+from .post_processing import compile_keyword_matcher
 from .retrieval_pipeline import RetrievalPipeline
 from ..emission.emissions_calculator import EmissionsCalculator
+from ..llm.context_budget import EMISSION_KEYWORDS
 from ..document_processor.extractor import DocumentExtractor
+from ..vector_store.store import hash_document
 from typing import Dict, Any, List
+from collections import OrderedDict
 import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+def _format_table(structured_data) -> str:
+    """Render OCR table rows as lines of ' | '-separated cells instead of a list repr"""
+    if isinstance(structured_data, list):
+        rows = (" | ".join(map(str, row)) if isinstance(row, list) else str(row) for row in structured_data)
+        return "Table data:\n" + "\n".join(rows)
+    return f"Table data: {structured_data}"
 
 class EmissionsPipeline:
     """
@@ -25,82 +41,111 @@ class EmissionsPipeline:
         self.emissions_calculator = EmissionsCalculator()
         self.extractor = DocumentExtractor()  # Direct access to extractor for full text
         
-    def process_document_for_emissions(self, document_path: str) -> Dict[str, Any]:
+        # Cheap precheck for documents that can't contain emission-relevant activities
+        self._mentions_emissions = compile_keyword_matcher(
+            EMISSION_KEYWORDS + ('scope 1', 'scope 2', 'scope 3', 'emission', 'co2', 'carbon', 'ghg', 'greenhouse')
+        )
+        
+        # Ingested documents keyed by content hash, so repeat calls skip extraction and storage
+        # even when the same upload arrives under a new temporary path. The pipeline is
+        # shared between Streamlit sessions, hence the lock
+        self._ingested = OrderedDict()
+        self._ingested_max = 32
+        self._ingested_lock = threading.Lock()
+        
+    def _ingest(self, document_path: str, content_hash: str = None) -> Dict[str, Any]:
+        """Extract a document once and ingest it, reusing the result for identical content"""
+        key = content_hash or hash_document(document_path)
+        with self._ingested_lock:
+            if key in self._ingested:
+                self._ingested.move_to_end(key)
+                return self._ingested[key]
+        
+        extraction_result = self.ingestion.ingest_extracted(
+            self.extractor.extract_from_pdf(document_path), document_path, content_hash=key
+        )
+        # Table crops were only needed for OCR; keeping them would pin page images in memory
+        extraction_result = dict(extraction_result, tables=[
+            {k: v for k, v in table.items() if k != 'image'} for table in extraction_result['tables']
+        ])
+        
+        with self._ingested_lock:
+            self._ingested[key] = extraction_result
+            self._ingested.move_to_end(key)
+            if len(self._ingested) > self._ingested_max:
+                self._ingested.popitem(last=False)
+        return extraction_result
+        
+    def process_document_for_emissions(self, document_path: str, content_hash: str = None) -> Dict[str, Any]:
         """
         Process a document and calculate emissions based on its content
         
         Args:
             document_path: Path to the document
+            content_hash: Content hash of the document, if already known (computed otherwise)
             
         Returns:
             Dictionary with extracted content, activities, and emissions calculations
         """
-        # Process the document through the ingestion pipeline
-        extraction_result = self.ingestion.process_document(document_path)
-        print(f"Document processed with {len(extraction_result['text'])} text segments")
-        
-        # IMPORTANT: Get the FULL document text directly from the extractor to avoid truncation
-        doc = self.extractor.extract_from_pdf(document_path)
-        
-        # Get document content for analysis
-        document_content = []
-        
-        # Add text segments to document content - USING FULL TEXT
-        for text_segment in doc['text']:
-            if not text_segment['content'] or len(text_segment['content'].strip()) < 10:
-                continue
-                
-            document_content.append({
+        # Extract the document once and ingest it; the extraction result holds
+        # the full, non-truncated text (only the embedder truncates its copies)
+        extraction_result = self._ingest(document_path, content_hash)
+        logger.info("Document processed with %d text segments", len(extraction_result['text']))
+        
+        # Format table and chart content once; the precheck and the analysis share it
+        table_texts = [
+            (i, _format_table(table['structured_data']))
+            for i, table in enumerate(extraction_result['tables']) if table.get('structured_data')
+        ]
+        chart_texts = [
+            (i, f"Chart data: {chart['data']}")
+            for i, chart in enumerate(extraction_result['charts']) if chart.get('data')
+        ]
+        
+        # Skip building the analysis content and the LLM call when nothing in the
+        # document mentions an emission-relevant term
+        if not self._has_emission_terms(extraction_result['text'], table_texts, chart_texts):
+            logger.info("No emission-relevant terms found, skipping activity extraction")
+            return self._no_activities_result(document_path, extraction_result)
+        
+        # Get document content for analysis, starting with the text segments - USING FULL TEXT
+        document_content = [
+            {
                 'text': text_segment['content'],  # This is the full, non-truncated text
                 'metadata': {
                     'document_path': document_path,
                     'page_num': text_segment.get('page_num', 0),
                     'type': 'text'
                 }
-            })
-        
-        # Add table content if available
-        for i, table in enumerate(extraction_result['tables']):
-            if 'structured_data' in table and table['structured_data']:
-                document_content.append({
-                    'text': f"Table data: {table['structured_data']}",
-                    'metadata': {
-                        'document_path': document_path,
-                        'type': 'table',
-                        'table_index': i
-                    }
-                })
-        
-        # Add chart content if available
-        for i, chart in enumerate(extraction_result['charts']):
-            if 'data' in chart and chart['data']:
-                document_content.append({
-                    'text': f"Chart data: {chart['data']}",
-                    'metadata': {
-                        'document_path': document_path,
-                        'type': 'chart',
-                        'chart_index': i
-                    }
-                })
-        
-        print(f"Extracting emission-relevant activities from {len(document_content)} content segments")
-        print(f"Content size (characters): {sum(len(segment['text']) for segment in document_content)}")
-        
-        # Extract emission-relevant activities from the document
-        activities = self.emissions_calculator.extract_activities(document_content)
-        print(f"Extracted {len(activities)} emission-relevant activities")
+            }
+            for text_segment in extraction_result['text']
+            if is_substantial_text(text_segment['content'])
+        ]
+        
+        # Add table and chart content if available, copying one metadata template per type
+        table_meta = {'document_path': document_path, 'type': 'table'}
+        document_content.extend(
+            {'text': text, 'metadata': dict(table_meta, table_index=i)} for i, text in table_texts
+        )
+        chart_meta = {'document_path': document_path, 'type': 'chart'}
+        document_content.extend(
+            {'text': text, 'metadata': dict(chart_meta, chart_index=i)} for i, text in chart_texts
+        )
+        
+        logger.info("Extracting emission-relevant activities from %d content segments", len(document_content))
+        # Only total up the content size when it will actually be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Content size (characters): %d", sum(len(segment['text']) for segment in document_content))
+        
+        # Extract emission-relevant activities from the document, looking up
+        # emission factors while the LLM response is still streaming
+        activities = self.emissions_calculator.extract_activities_with_factors(document_content)
+        logger.info("Extracted %d emission-relevant activities", len(activities))
         
         if not activities:
-            return {
-                'document_path': document_path,
-                'extraction_result': extraction_result,
-                'activities': [],
-                'emissions_calculation': {
-                    'error': 'No emission-relevant activities found in the document'
-                }
-            }
+            return self._no_activities_result(document_path, extraction_result)
         
-        print(f"Calculating emissions for {len(activities)} activities")
+        logger.info("Calculating emissions for %d activities", len(activities))
         
         # Calculate emissions for the extracted activities
         emissions_calculation = self.emissions_calculator.calculate_emissions(activities)
@@ -113,18 +158,38 @@ class EmissionsPipeline:
             'emissions_calculation': emissions_calculation
         }
     
-    def get_document_summary_for_emissions(self, document_path: str) -> Dict[str, Any]:
+    def _has_emission_terms(self, text_segments, table_texts, chart_texts) -> bool:
+        """Check whether any text, table or chart of a document mentions an emission keyword"""
+        texts = [segment['content'] for segment in text_segments if segment['content']]
+        texts += [text for _, text in table_texts]
+        texts += [text for _, text in chart_texts]
+        return any(map(self._mentions_emissions, texts))
+    
+    @staticmethod
+    def _no_activities_result(document_path: str, extraction_result: Dict[str, Any]) -> Dict[str, Any]:
+        """Build the result returned when a document has no emission-relevant activities"""
+        return {
+            'document_path': document_path,
+            'extraction_result': extraction_result,
+            'activities': [],
+            'emissions_calculation': {
+                'error': 'No emission-relevant activities found in the document'
+            }
+        }
+    
+    def get_document_summary_for_emissions(self, document_path: str, content_hash: str = None) -> Dict[str, Any]:
         """
         Get a summary of a document focused on emissions-relevant information
         
         Args:
             document_path: Path to the document
+            content_hash: Content hash of the document, if already known (computed otherwise)
             
         Returns:
             Dictionary with document summary and key emissions information
         """
-        # First extract the document content
-        extraction_result = self.ingestion.process_document(document_path)
+        # First extract the document content (reused if it was already ingested)
+        self._ingest(document_path, content_hash)
         
         # Generate a summary query focused on emissions
         query = "Extract information related to greenhouse gas emissions, energy usage, transportation, material consumption, and waste generation."
@@ -1,103 +1,278 @@
 from core.document_processor.extractor import DocumentExtractor
 from core.document_processor.ocr import OCRProcessor
 from core.embedding.embedder import DocumentEmbedder
-from pymilvus import Collection, connections
+from core.embedding.embedding_cache import open_embedding_cache
+from core.vector_store.store import to_vector_field, make_doc_ids, dedupe_rows, split_text_field, hash_document
+from core.vector_store.milvus_client import get_collection, bump_collection_version
+from concurrent.futures import ThreadPoolExecutor
 import os
+import logging
 
-class IngestionPipeline:
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+# Milvus flushes run here, one at a time, so ingestion can move on to the next batch
+_flush_executor = ThreadPoolExecutor(max_workers=1)
+
+def is_substantial_text(text, min_chars=10):
+    """Check that a text segment has at least min_chars characters once surrounding whitespace is removed"""
+    if not text or len(text) < min_chars:
+        return False
+    # Only strip (and copy) texts that actually have surrounding whitespace
+    if text[0].isspace() or text[-1].isspace():
+        return len(text.strip()) >= min_chars
+    return True
+
+class _PendingSegments:
+    """Text segments queued by one ingestion call, and the latest Milvus flush it started"""
     def __init__(self):
+        self.texts = []
+        self.metadata = []
+        self.flush_future = None
+
+class IngestionPipeline:
+    def __init__(self, batch_size=None, use_embedding_cache=True, cache_dir=None):
         self.extractor = DocumentExtractor()
         self.ocr = OCRProcessor()
         self.embedder = DocumentEmbedder()
+        # Embeddings of previously seen segments, so only new text is sent to the embedder
+        self.embedding_cache = open_embedding_cache(cache_dir) if use_embedding_cache else None
         
-    def process_document(self, pdf_path):
-        """Process a document through the complete pipeline"""
+        # Text segments are queued across the documents of one call and embedded/stored in
+        # batches of this size. The queue is local to each call (the pipeline is shared
+        # between Streamlit sessions), so a failed call's segments are simply dropped
+        self.batch_size = batch_size or int(os.getenv('INGEST_BATCH_SIZE', '128'))
+        
+    def process_document(self, pdf_path, content_hash=None):
+        """
+        Process a document through the complete pipeline
+        
+        Args:
+            pdf_path: Path of the PDF document
+            content_hash: Content hash of the document, if already known (computed otherwise);
+                segments are keyed on it, so re-ingesting the same file replaces its rows
+        """
         try:
-            print(f"Processing document: {pdf_path}")
-            
-            # Extract content from PDF
-            extracted_content = self.extractor.extract_from_pdf(pdf_path)
-            print(f"Extracted {len(extracted_content['text'])} text segments, {len(extracted_content['tables'])} tables, and {len(extracted_content['charts'])} charts")
-            
-            # Process tables with OCR if any found
-            for table in extracted_content['tables']:
-                table_text = self.ocr.process_table(table['image'])
-                table['structured_data'] = table_text
-            
-            # Generate embeddings for text segments
-            texts = []
-            metadata = []
-            for text_segment in extracted_content['text']:
-                # Skip empty text segments
-                if not text_segment['content'] or len(text_segment['content'].strip()) < 10:
-                    continue
-                    
-                texts.append(text_segment['content'])
-                # Add page number and position as metadata
-                metadata.append({
-                    "page_num": text_segment.get('page_num', 0),
-                    "position": text_segment.get('position', {}),
-                    "document_path": pdf_path
-                })
-            
-            print(f"Generating embeddings for {len(texts)} text segments")
-            
-            # Generate embeddings with metadata
-            if texts:
-                embedding_results = self.embedder.embed_batch_with_metadata(texts, metadata)
-                
-                # Store in Milvus
-                inserted_count = self._store_in_milvus(embedding_results)
-                print(f"Stored {inserted_count} text segments in vector database")
-            else:
-                print("No valid text segments found to embed")
+            pending = _PendingSegments()
+            extracted_content = self._extract_and_queue(pdf_path, pending, content_hash)
+            self.flush_batch(pending)
+            self.wait_for_flush(pending)
+            return extracted_content
+            
+        except Exception as e:
+            logger.warning("Document processing error: %s", e)
+            raise Exception(f"Document processing failed: {str(e)}")
+    
+    def process_documents(self, pdf_paths, batch_size=None):
+        """
+        Process several documents, embedding their text segments in shared batches
+        
+        Args:
+            pdf_paths: Paths of the PDF documents to ingest
+            batch_size: Texts per embedding/insert batch (defaults to self.batch_size)
+            
+        Returns:
+            The extracted content of each document, in the order given
+        """
+        batch_size = batch_size or self.batch_size
+        try:
+            pending = _PendingSegments()
+            extracted_contents = []
+            for pdf_path in pdf_paths:
+                extracted_contents.append(self._extract_and_queue(pdf_path, pending))
+                # Flush full batches as they fill so the queue stays bounded
+                if len(pending.texts) >= batch_size:
+                    self.flush_batch(pending, batch_size, only_full=True)
+            self.flush_batch(pending, batch_size)
+            self.wait_for_flush(pending)
+            return extracted_contents
+            
+        except Exception as e:
+            logger.warning("Document processing error: %s", e)
+            raise Exception(f"Document processing failed: {str(e)}")
+    
+    def flush_batch(self, pending, batch_size=None, only_full=False):
+        """
+        Embed and store the queued text segments
+        
+        Args:
+            pending: The call's queued segments; stored batches are removed from it
+            batch_size: Texts per embedding/insert batch (defaults to self.batch_size)
+            only_full: Leave a trailing partial batch queued for the next flush
+            
+        Returns:
+            Number of records stored
+        """
+        batch_size = batch_size or self.batch_size
+        if not pending.texts:
+            logger.info("No valid text segments found to embed")
+            return 0
+        
+        inserted_count = 0
+        while len(pending.texts) >= (batch_size if only_full else 1):
+            texts = pending.texts[:batch_size]
+            metadata = pending.metadata[:batch_size]
+            
+            logger.info("Generating embeddings for %d text segments", len(texts))
+            embedding_results = self._embed_with_cache(texts, metadata)
+            
+            # Store in Milvus
+            stored = self._store_in_milvus(embedding_results, pending)
+            logger.info("Stored %d text segments in vector database", stored)
+            inserted_count += stored
+            
+            # Only drop the batch from the queue once it has been stored
+            del pending.texts[:batch_size], pending.metadata[:batch_size]
+        return inserted_count
+    
+    def wait_for_flush(self, pending):
+        """Block until the call's latest background Milvus flush (and every earlier one) has finished"""
+        if pending.flush_future is None:
+            return
+        future, pending.flush_future = pending.flush_future, None
+        try:
+            future.result()
+        except Exception as e:
+            raise Exception(f"Failed to flush vector database: {str(e)}")
+    
+    def _embed_with_cache(self, texts, metadata):
+        """Embed texts like embed_batch_with_metadata, only sending cache misses to the embedder"""
+        if self.embedding_cache is None:
+            return self.embedder.embed_batch_with_metadata(texts, metadata)
+        
+        keys = [self.embedding_cache.make_key(text) for text in texts]
+        cached = self.embedding_cache.get_many(self.embedder.model, keys)
+        embeddings = [cached.get(key) for key in keys]
+        
+        # Embed each missing text once, even if it repeats within the batch
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(keys[i], i)
+        logger.debug("Embedding cache hits: %d/%d text segments", len(texts) - len(missing), len(texts))
+        
+        if missing:
+            missing_keys = list(missing)
+            new_embeddings = self.embedder.embed_batch([texts[missing[key]] for key in missing_keys])
+            self.embedding_cache.put_many(self.embedder.model, missing_keys, new_embeddings)
+            by_key = dict(zip(missing_keys, new_embeddings))
+            embeddings = [by_key[key] if embedding is None else embedding
+                          for key, embedding in zip(keys, embeddings)]
+        
+        return {
+            "ids": list(range(len(texts))),
+            "embeddings": embeddings,
+            "texts": texts,
+            "metadata": metadata
+        }
+    
+    def ingest_extracted(self, extracted_content, pdf_path, content_hash=None):
+        """
+        OCR, embed and store content that has already been extracted from a PDF
+        
+        Args:
+            extracted_content: Result of DocumentExtractor.extract_from_pdf for the document
+            pdf_path: Path of the document, recorded in the segment metadata
+            content_hash: Content hash of the document, if already known (computed otherwise)
             
+        Returns:
+            The extracted content, with OCR results added to its tables
+        """
+        try:
+            pending = _PendingSegments()
+            self._queue_extracted(extracted_content, pdf_path, pending, content_hash)
+            self.flush_batch(pending)
+            self.wait_for_flush(pending)
             return extracted_content
             
         except Exception as e:
-            print(f"Document processing error: {str(e)}")
+            logger.warning("Document processing error: %s", e)
             raise Exception(f"Document processing failed: {str(e)}")
+    
+    def _extract_and_queue(self, pdf_path, pending, content_hash=None):
+        """Extract a document, OCR its tables and queue its text segments for embedding"""
+        logger.info("Processing document: %s", pdf_path)
+        
+        # Extract content from PDF
+        extracted_content = self.extractor.extract_from_pdf(pdf_path)
+        return self._queue_extracted(extracted_content, pdf_path, pending, content_hash)
+    
+    def _queue_extracted(self, extracted_content, pdf_path, pending, content_hash=None):
+        """OCR the tables of extracted content and queue its text segments for embedding"""
+        logger.info("Extracted %d text segments, %d tables, and %d charts", len(extracted_content['text']),
+                    len(extracted_content['tables']), len(extracted_content['charts']))
+        
+        # Process tables with OCR if any found (requests run concurrently)
+        tables = extracted_content['tables']
+        table_texts = self.ocr.process_tables([table['image'] for table in tables])
+        for table, table_text in zip(tables, table_texts):
+            table['structured_data'] = table_text
+        
+        # Segments are keyed on the document's content, not its (often temporary) path
+        content_hash = content_hash or hash_document(pdf_path)
+        
+        # Queue text segments for embedding, skipping empty ones. Segments longer than the
+        # text field are queued as several parts, so the whole page text is stored
+        for segment in extracted_content['text']:
+            if not is_substantial_text(segment['content']):
+                continue
+            # Add page number and position as metadata
+            metadata = {
+                "page_num": segment.get('page_num', 0),
+                "position": segment.get('position', {}),
+                "document_path": pdf_path,
+                "document_hash": content_hash
+            }
+            parts = split_text_field(segment['content'])
+            pending.texts.extend(parts)
+            if len(parts) == 1:
+                pending.metadata.append(metadata)
+            else:
+                pending.metadata.extend(dict(metadata, part=i) for i in range(len(parts)))
+        
+        return extracted_content
             
-    def _store_in_milvus(self, embedding_results):
+    def _store_in_milvus(self, embedding_results, pending):
         """Store text and embeddings in Milvus"""
         try:
-            # Connect to Milvus if not already connected
-            try:
-                connections.connect(
-                    "default",
-                    uri=os.getenv('MILVUS_URI'),
-                    token=os.getenv('MILVUS_TOKEN')
-                )
-                print("Connected to Milvus for document storage")
-            except Exception as e:
-                print(f"Connection already exists or error: {str(e)}")
-            
-            collection = Collection("vector_db")
+            collection = get_collection("vector_db")
             
             # Debug information
-            print(f"Storing {len(embedding_results['texts'])} text segments in Milvus")
-            print(f"First text: {embedding_results['texts'][0][:100]}...")
-            print(f"First metadata: {embedding_results['metadata'][0]}")
-            
-            # Insert data in the correct format for Milvus
-            # Note: 'id' field is auto-generated, so we don't provide it
-            insert_result = collection.insert([
-                ["doc_" + str(id) for id in embedding_results["ids"]],  # doc_id field
-                embedding_results["texts"],                            # text field
-                embedding_results["embeddings"],                       # embedding field
-                embedding_results["metadata"]                          # metadata field
+            logger.debug("Storing %d text segments in Milvus; first text: %.100s...; first metadata: %s",
+                         len(embedding_results['texts']), embedding_results['texts'][0],
+                         embedding_results['metadata'][0])
+            
+            # Key each segment by its file and content, so re-ingesting a document
+            # replaces its rows instead of duplicating them
+            doc_ids = make_doc_ids(embedding_results["texts"], embedding_results["metadata"])
+            doc_ids, texts, vectors, metadata = dedupe_rows(
+                doc_ids,
+                embedding_results["texts"],
+                to_vector_field(collection, embedding_results["embeddings"]),
+                embedding_results["metadata"]
+            )
+            
+            # Upsert data in the correct format for Milvus
+            upsert_result = collection.upsert([
+                doc_ids,     # doc_id field (primary key)
+                texts,       # text field
+                vectors,     # embedding field
+                metadata     # metadata field
             ])
             
-            # Flush to ensure data is persisted
-            collection.flush()
+            bump_collection_version("vector_db")
+            
+            # Flush in the background to persist the data; flushes run in order on
+            # one worker, so waiting for the latest covers all earlier inserts
+            pending.flush_future = _flush_executor.submit(collection.flush)
             
             # Print confirmation
-            print(f"Successfully inserted {insert_result.insert_count} records into Milvus")
-            print(f"IDs: {insert_result.primary_keys[:5]}...")
+            logger.debug("Upserted %d records into Milvus, IDs: %s...",
+                         upsert_result.upsert_count, upsert_result.primary_keys[:5])
             
-            return insert_result.insert_count
+            return upsert_result.upsert_count
         except Exception as e:
-            print(f"Error storing in Milvus: {str(e)}")
+            logger.warning("Error storing in Milvus: %s", e)
             if hasattr(e, 'response') and e.response is not None:
-                print(f"Response: {e.response.text}")
+                logger.warning("Response: %s", e.response.text)
             raise Exception(f"Failed to store document in vector database: {str(e)}") 
\ No newline at end of file
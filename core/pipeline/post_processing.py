@@ -1,24 +1,52 @@
+import re
+from itertools import islice
+
+try:
+    # Aho-Corasick automaton: one pass over the text regardless of the number of keywords
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+def compile_keyword_matcher(keywords):
+    """Build a case-insensitive matcher returning True if any keyword occurs in a text"""
+    keywords = [keyword.lower() for keyword in keywords if keyword]
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for keyword in keywords:
+            automaton.add_word(keyword, keyword)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.lower()), None) is not None
+
+    # Fall back to one compiled alternation instead of a per-keyword loop
+    pattern = re.compile("|".join(map(re.escape, sorted(keywords, key=len, reverse=True))), re.IGNORECASE)
+    return lambda text: pattern.search(text) is not None
+
 class PostProcessing:
-    def __init__(self):
-        pass
+    def __init__(self, keywords=None, min_length=50):
+        """
+        Initialize post-processing
+
+        Args:
+            keywords: Optional terms an item must contain (case-insensitive) to be kept
+            min_length: Minimum content length for an item to be kept
+        """
+        self.min_length = min_length
+        self._keyword_matcher = compile_keyword_matcher(keywords) if keywords else None
 
     def filter_data(self, extracted_data):
-        """Filter out unnecessary or low-quality data."""
-        filtered_data = []
-        for item in extracted_data:
-            if self._is_valid(item):
-                filtered_data.append(item)
-        return filtered_data
+        """Filter out unnecessary or low-quality data, lazily (wrap in list() if needed)."""
+        return filter(self._is_valid, extracted_data)
 
     def _is_valid(self, item):
         """Check if the item meets certain criteria."""
-        # Example criteria: length of text, presence of certain keywords, etc.
-        return len(item['content']) > 50  # Example condition
-
-    def chunk_data(self, filtered_data):
-        """Chunk the data into manageable pieces."""
-        chunked_data = []
-        chunk_size = 5  # Example chunk size
-        for i in range(0, len(filtered_data), chunk_size):
-            chunked_data.append(filtered_data[i:i + chunk_size])
-        return chunked_data 
\ No newline at end of file
+        # Criteria: length of text and, if configured, presence of a keyword
+        content = item['content']
+        if len(content) <= self.min_length:
+            return False
+        return self._keyword_matcher is None or self._keyword_matcher(content)
+
+    def chunk_data(self, filtered_data, chunk_size=5):
+        """Chunk the data into manageable pieces, yielded one list at a time."""
+        # Works on any iterable, so filter_data's output is chunked without materializing it
+        it = iter(filtered_data)
+        return iter(lambda: list(islice(it, chunk_size)), [])
@@ -1,29 +1,90 @@
-from pymilvus import Collection, connections
+import os
+import copy
+import time
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from ..vector_store.milvus_client import get_collection, default_search_params, collection_version
+from ..vector_store.store import to_vector_field
 from ..embedding.embedder import DocumentEmbedder
 from ..ranking.reranker import DocumentReranker
 from ..llm.answer_generator import LLMAnswerGenerator
-import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+# Retrieval results of recent queries, shared by pipeline instances. Keys include the
+# collection's write version, so anything ingested by this process invalidates them
+_QUERY_CACHE = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+_QUERY_CACHE_SIZE = 512
+_QUERY_CACHE_TTL = 300  # seconds
+
+def _query_cache_get(cache_key):
+    """Get a copy of unexpired cached query results, or None"""
+    with _QUERY_CACHE_LOCK:
+        entry = _QUERY_CACHE.get(cache_key)
+        if entry is None:
+            return None
+        stored_at, result = entry
+        if time.monotonic() - stored_at > _QUERY_CACHE_TTL:
+            del _QUERY_CACHE[cache_key]
+            return None
+        _QUERY_CACHE.move_to_end(cache_key)
+    # Copied so callers can't modify the cached results
+    return copy.deepcopy(result)
+
+def _query_cache_put(cache_key, result):
+    """Store a copy of query results, evicting the least recently used entries"""
+    result = copy.deepcopy(result)
+    with _QUERY_CACHE_LOCK:
+        _QUERY_CACHE[cache_key] = (time.monotonic(), result)
+        _QUERY_CACHE.move_to_end(cache_key)
+        while len(_QUERY_CACHE) > _QUERY_CACHE_SIZE:
+            _QUERY_CACHE.popitem(last=False)
+
+def _log_results(title, results):
+    """Log each result's score, doc ID and a text snippet at debug level"""
+    # Skip building the snippets entirely unless debug logging is on
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("=== %s ===", title)
+    for i, result in enumerate(results):
+        logger.debug("Result %d: score=%s doc_id=%s text=%.150s...", i + 1, result.get('score', 0.0),
+                     result.get('doc_id', 'unknown'), result.get('text', ''))
 
 class RetrievalPipeline:
-    def __init__(self, milvus_collection_name="vector_db"):
+    def __init__(self, milvus_collection_name="vector_db", search_params=None, max_concurrency=4):
         self.embedder = DocumentEmbedder()
         self.reranker = DocumentReranker()
         self.llm = LLMAnswerGenerator()
+        self.max_concurrency = max_concurrency  # Queries reranked/answered at once in process_queries
+        self.collection_name = milvus_collection_name
+        
+        # Shared connection and collection handle (connects on first use)
+        self.collection = get_collection(milvus_collection_name)
+        
+        # Search parameters matching the collection's index (read once), unless given
+        self.search_params = search_params or default_search_params(self.collection)
         
-        # Connect to Milvus Cloud using URI and token
-        connections.connect(
-            "default",
-            uri=os.getenv('MILVUS_URI'),
-            token=os.getenv('MILVUS_TOKEN')
-        )
-        self.collection = Collection(milvus_collection_name)
+        # Load the collection into memory once; queries only reload after a failure
+        self._loaded = False
+        self._ensure_loaded()
+        if self._loaded:
+            logger.info("Collection %s loaded successfully", milvus_collection_name)
+        else:
+            logger.warning("Collection %s is not loaded yet", milvus_collection_name)
         
-        # Load the collection into memory
+    def _ensure_loaded(self):
+        """Load the collection unless it is already known to be loaded"""
+        if self._loaded:
+            return
         try:
             self.collection.load()
-            print(f"Collection {milvus_collection_name} loaded successfully")
+            self._loaded = True
         except Exception as e:
-            print(f"Warning: Could not load collection: {str(e)}")
+            logger.warning("Could not load collection: %s", e)
         
     def generate_answer(self, query, results, stream=False):
         """Generate an answer to the query using the LLM"""
@@ -34,35 +95,93 @@ class RetrievalPipeline:
         answer = self.llm.generate_answer(query, results, stream=stream)
         return answer
         
-    def process_query(self, query, k=5, generate_answer=False):
-        print(f"\n=== Processing query: '{query}' ===")
+    def process_query(self, query, k=5, generate_answer=False, stream=False):
+        """Retrieve (and optionally answer) a single query"""
+        return self.process_queries([query], k=k, generate_answer=generate_answer, stream=stream)[0]
+    
+    def process_queries(self, queries, k=5, generate_answer=False, stream=False):
+        """
+        Retrieve results for several queries with one embedding call and one Milvus search
         
-        # Try to load the collection (this is idempotent in Milvus)
-        try:
-            self.collection.load()
-            print("Collection loaded successfully")
-        except Exception as e:
-            print(f"Warning: Error loading collection: {str(e)}")
+        Args:
+            queries: List of queries
+            k: Number of results to retrieve per query
+            generate_answer: Whether to generate an LLM answer for each query
+            stream: Return each answer as a token stream the UI can consume as it arrives
+            
+        Returns:
+            List with the process_query result of each query, in order
+        """
+        if not queries:
+            return []
+        
+        # Serve repeated queries from the cache; streamed answers can only be consumed once
+        results = [None] * len(queries)
+        cache_keys = [None] * len(queries)
+        if not stream:
+            version = collection_version(self.collection_name)
+            for i, query in enumerate(queries):
+                cache_keys[i] = (self.collection_name, version, query, k, generate_answer)
+                results[i] = _query_cache_get(cache_keys[i])
+        
+        pending = [i for i, result in enumerate(results) if result is None]
+        if pending:
+            retrieved = self._retrieve([queries[i] for i in pending], k, generate_answer, stream)
+            for i, (result, reranked) in zip(pending, retrieved):
+                results[i] = result
+                # Only cache reranked results; empty or fallback results come from a failed
+                # search or reranker call and shouldn't outlive the outage
+                if cache_keys[i] is not None and result and reranked:
+                    _query_cache_put(cache_keys[i], result)
+        return results
+    
+    def _retrieve(self, queries, k, generate_answer, stream):
+        """Embed, search, rerank and optionally answer queries, without the cache
         
-        # Generate query embedding
-        query_embedding = self.embedder.embed_text(query)
-        print(f"Generated embedding of dimension: {len(query_embedding)}")
+        Returns a (result, reranked) pair per query; reranked is False when the
+        search or reranking failed and the result is empty or un-reranked.
+        """
+        # Load the collection if an earlier load or search failed
+        self._ensure_loaded()
         
-        # Get initial results from Milvus
-        search_params = {"metric_type": "L2", "params": {"nprobe": 10}}
-        print("Searching Milvus...")
+        # Generate query embeddings in one batch
+        query_embeddings = self.embedder.embed_batch(queries)
+        logger.debug("Generated %d embeddings of dimension: %d", len(query_embeddings), len(query_embeddings[0]))
+        
+        # Get initial results from Milvus, searching all query vectors at once
+        logger.debug("Searching Milvus")
         
         try:
             results = self.collection.search(
-                data=[query_embedding],
+                data=to_vector_field(self.collection, query_embeddings),
                 anns_field="embedding",
-                param=search_params,
+                param=self.search_params,
                 limit=k,
                 expr=None,
                 output_fields=["text", "metadata", "doc_id"]  # Request all fields we need
             )
-            
-            print(f"Search returned {len(results[0])} results")
+        except Exception as e:
+            logger.warning("Error during search: %s", e)
+            # The collection may have been released; reload it on the next query
+            self._loaded = False
+            return [([], False) for _ in queries]
+        
+        # Reranking and answering are independent HTTP calls per query, so overlap them across queries
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(queries))) as executor:
+            return list(executor.map(
+                lambda query, hits: self._process_hits(query, hits, generate_answer, stream),
+                queries, results
+            ))
+    
+    def _process_hits(self, query, hits, generate_answer=False, stream=False):
+        """Rerank the search hits of one query and optionally generate an answer
+        
+        Returns the result and whether it was reranked successfully.
+        """
+        logger.info("Processing query: '%s'", query)
+        
+        try:
+            logger.debug("Search returned %d results", len(hits))
             
             # Extract text from results
             documents = []
@@ -70,39 +189,39 @@ class RetrievalPipeline:
             metadata_list = []
             doc_ids = []
             
-            for hit in results[0]:
+            for hit in hits:
                 try:
                     # Access fields directly from the entity object
                     text = hit.entity.text
                     metadata = hit.entity.metadata
                     doc_id = hit.entity.doc_id
                     
-                    print(f"Hit: doc_id={doc_id}, distance={hit.distance}")
-                    print(f"Text snippet: {text[:100]}...")
+                    logger.debug("Hit: doc_id=%s, distance=%s, text=%.100s...", doc_id, hit.distance, text)
                     
                     documents.append(text)
                     scores.append(hit.distance)
                     metadata_list.append(metadata)
                     doc_ids.append(doc_id)
                 except Exception as e:
-                    print(f"Error processing hit: {str(e)}")
-                    print(f"Hit entity fields: {dir(hit.entity)}")
+                    logger.warning("Error processing hit: %s (entity fields: %s)", e, dir(hit.entity))
             
             # Rerank results if we have documents
             if documents:
-                print(f"Reranking {len(documents)} documents...")
+                logger.debug("Reranking %d documents", len(documents))
                 try:
+                    # Reranker failures raise, so they take the fallback path below
                     reranked_results = self.reranker.rerank(
                         query=query,
                         documents=documents,
-                        scores=scores
+                        scores=scores,
+                        raise_on_error=True
                     )
                     
-                    print(f"Reranking returned {len(reranked_results)} results")
+                    logger.debug("Reranking returned %d results", len(reranked_results))
                     
                     # If reranker returned no results, create results from original documents
                     if not reranked_results:
-                        print("Creating results from original documents")
+                        logger.info("Creating results from original documents")
                         reranked_results = [
                             {"text": doc, "score": score} 
                             for doc, score in zip(documents, scores)
@@ -115,44 +234,30 @@ class RetrievalPipeline:
                         if i < len(doc_ids):
                             result["doc_id"] = doc_ids[i]
                     
-                    # Print final results
-                    print("\n=== Final Results ===")
-                    for i, result in enumerate(reranked_results):
-                        print(f"Result {i+1}:")
-                        print(f"  Score: {result.get('score', 0.0)}")
-                        print(f"  Doc ID: {result.get('doc_id', 'unknown')}")
-                        print(f"  Text: {result.get('text', '')[:150]}...")
-                        print()
+                    _log_results("Final Results", reranked_results)
                     
                     # After getting the reranked results, generate an answer if requested
                     if generate_answer and reranked_results:
-                        print("Generating answer with LLM...")
-                        answer = self.generate_answer(query, reranked_results)
+                        logger.debug("Generating answer with LLM")
+                        answer = self.generate_answer(query, reranked_results, stream=stream)
                         return {
                             "results": reranked_results,
                             "answer": answer
-                        }
+                        }, True
                     
-                    return reranked_results
+                    return reranked_results, True
                 except Exception as e:
-                    print(f"Error during reranking: {str(e)}")
+                    logger.warning("Error during reranking: %s", e)
                     # Fall back to original results if reranking fails
                     results = [{"text": doc, "score": score, "metadata": meta, "doc_id": doc_id} 
                             for doc, score, meta, doc_id in zip(documents, scores, metadata_list, doc_ids)]
                     
-                    # Print fallback results
-                    print("\n=== Fallback Results (No Reranking) ===")
-                    for i, result in enumerate(results):
-                        print(f"Result {i+1}:")
-                        print(f"  Score: {result.get('score', 0.0)}")
-                        print(f"  Doc ID: {result.get('doc_id', 'unknown')}")
-                        print(f"  Text: {result.get('text', '')[:150]}...")
-                        print()
+                    _log_results("Fallback Results (No Reranking)", results)
                     
-                    return results
+                    return results, False
             else:
-                print("No documents found in vector database")
-                return []
+                logger.info("No documents found in vector database")
+                return [], False
         except Exception as e:
-            print(f"Error during search: {str(e)}")
-            return [] 
\ No newline at end of file
+            logger.warning("Error processing search results: %s", e)
+            return [], False
@@ -1,15 +1,38 @@
-import requests
 import os
+import logging
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
 
 class DocumentReranker:
-    def __init__(self):
+    def __init__(self, max_concurrency=8):
         self.api_key = os.getenv('NVIDIA_RERANK_KEY')
         self.rerank_endpoint = os.getenv('NVIDIA_RERANK_ENDPOINT')
-        self.session = requests.Session()
+        self.max_concurrency = max_concurrency  # Max in-flight rerank requests in rerank_batch
+        
+        # One keep-alive client shared by all calls (httpx clients are thread-safe);
+        # HTTP/2 multiplexes concurrent reranks over one connection when `h2` is installed
+        self.client = httpx.Client(
+            transport=httpx.HTTPTransport(
+                http2=importlib.util.find_spec("h2") is not None,
+                retries=3,  # Connection failures only
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+            ),
+            timeout=10
+        )
+        
+    def rerank(self, query, documents, scores=None, raise_on_error=False):
+        """
+        Rerank documents using NVIDIA llama-3.2-nv-rerankqa-1b-v2
         
-    def rerank(self, query, documents, scores=None):
-        """Rerank documents using NVIDIA llama-3.2-nv-rerankqa-1b-v2"""
-        print(f"Reranking {len(documents)} documents with query: '{query[:50]}...'")
+        Falls back to the original documents and scores when the API call fails
+        or returns nothing, unless raise_on_error is set, in which case the failure
+        is raised so callers can tell fallback results from reranked ones.
+        """
+        logger.debug("Reranking %d documents with query: '%.50s'", len(documents), query)
         
         headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -23,7 +46,7 @@ class DocumentReranker:
         }
         
         try:
-            response = self.session.post(
+            response = self.client.post(
                 self.rerank_endpoint,
                 headers=headers,
                 json=payload
@@ -32,7 +55,7 @@ class DocumentReranker:
             
             # Process the response to return a list of dictionaries
             response_data = response.json()
-            print(f"Reranker API response: {response_data}")
+            logger.debug("Reranker API response: %s", response_data)
             
             # Format the results as a list of dictionaries
             formatted_results = []
@@ -45,7 +68,9 @@ class DocumentReranker:
             
             # If no results from reranker, fall back to original documents
             if not formatted_results and documents:
-                print("No results from reranker, falling back to original documents")
+                if raise_on_error:
+                    raise Exception("Reranker returned no results")
+                logger.info("No results from reranker, falling back to original documents")
                 for i, doc in enumerate(documents):
                     score = scores[i] if scores and i < len(scores) else 0.0
                     formatted_results.append({
@@ -55,7 +80,30 @@ class DocumentReranker:
             
             return formatted_results
         except Exception as e:
-            print(f"Reranking API request failed: {str(e)}")
+            if raise_on_error:
+                raise Exception(f"Reranking API request failed: {str(e)}")
+            logger.warning("Reranking API request failed: %s", e)
             # Fall back to original documents in case of error
             return [{"text": doc, "score": scores[i] if scores and i < len(scores) else 0.0} 
-                    for i, doc in enumerate(documents)] 
\ No newline at end of file
+                    for i, doc in enumerate(documents)]
+    
+    def rerank_batch(self, queries, documents_list, scores_list=None):
+        """
+        Rerank the documents for several queries concurrently
+        
+        Args:
+            queries: List of queries
+            documents_list: List of document lists, one per query
+            scores_list: Optional list of fallback score lists, one per query
+            
+        Returns:
+            List of reranked results, in the same order as the queries
+        """
+        if scores_list is None:
+            scores_list = [None] * len(queries)
+        if not queries:
+            return []
+        
+        # Each rerank handles its own errors, so one failed call can't fail the batch
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(queries))) as executor:
+            return list(executor.map(self.rerank, queries, documents_list, scores_list))
@@ -0,0 +1,91 @@
+import os
+import functools
+import logging
+import threading
+from pymilvus import Collection, connections
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+_connect_lock = threading.Lock()
+
+# Per-collection write counters; caches of query results include the version in their keys
+_collection_versions = {}
+_versions_lock = threading.Lock()
+
+# gRPC channel options, pinned so 10k-row insert batches (~20MB of float16 vectors)
+# travel as one message and idle channels stay open between Streamlit queries.
+# Compression is left off: float vectors barely compress and gzip costs CPU per call
+_MAX_MESSAGE_BYTES = 256 * 1024 * 1024
+_GRPC_OPTIONS = {
+    "grpc.max_send_message_length": _MAX_MESSAGE_BYTES,
+    "grpc.max_receive_message_length": _MAX_MESSAGE_BYTES,
+    "grpc.keepalive_time_ms": 30000,
+}
+
+def connect(alias="default"):
+    """Connect to Milvus Cloud using MILVUS_URI and MILVUS_TOKEN, once per process"""
+    with _connect_lock:
+        if not connections.has_connection(alias):
+            connections.connect(
+                alias,
+                uri=os.getenv('MILVUS_URI'),
+                token=os.getenv('MILVUS_TOKEN'),
+                grpc_options=_GRPC_OPTIONS
+            )
+            logger.info("Connected to Milvus Cloud")
+
+def collection_version(name="vector_db"):
+    """Return the number of writes this process has made to a collection"""
+    with _versions_lock:
+        return _collection_versions.get(name, 0)
+
+def bump_collection_version(name="vector_db"):
+    """Record a write to a collection, invalidating cached query results for it"""
+    with _versions_lock:
+        _collection_versions[name] = _collection_versions.get(name, 0) + 1
+
+@functools.lru_cache(maxsize=None)
+def get_collection(name="vector_db"):
+    """
+    Get a Milvus collection, shared across the process
+    
+    The connection is opened on first use and every caller reuses the same
+    gRPC channel and Collection object, so collection metadata is only
+    fetched once.
+    
+    Args:
+        name: Name of the collection
+    """
+    connect()
+    return Collection(name)
+
+def release_collection(name="vector_db"):
+    """Release a loaded collection from memory (the next load() reloads it)"""
+    get_collection(name).release()
+
+# Search parameter templates per index type; HNSW takes a candidate list size, IVF a cluster count.
+# For IVF_RABITQ, rbq_bits_query=0 leaves queries unquantized and refine_k=1 re-ranks exactly the top k
+_SEARCH_PARAM_TEMPLATES = {
+    "HNSW": {"ef": 64},
+    "IVF_RABITQ": {"nprobe": 32, "rbq_bits_query": 0, "refine_k": 1},
+    "IVF_FLAT": {"nprobe": 10},
+    "IVF_SQ8": {"nprobe": 10},
+    "IVF_PQ": {"nprobe": 10},
+}
+
+def get_index_type(collection, field_name="embedding"):
+    """Return the index type and metric of a collection's vector field, or (None, "L2") if unknown"""
+    try:
+        for index in collection.indexes:
+            if index.field_name == field_name:
+                return index.params.get("index_type"), index.params.get("metric_type", "L2")
+    except Exception as e:
+        logger.warning("Could not read index of collection: %s", e)
+    return None, "L2"
+
+def default_search_params(collection, field_name="embedding"):
+    """Build search parameters that match the index on a collection's vector field"""
+    index_type, metric_type = get_index_type(collection, field_name)
+    params = _SEARCH_PARAM_TEMPLATES.get(index_type, {"nprobe": 10})
+    return {"metric_type": metric_type, "params": dict(params)}
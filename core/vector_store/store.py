@@ -1,37 +1,217 @@
 import os
+import copy
+import json
+import logging
+import time
+import hashlib
+import threading
 import numpy as np
+from collections import OrderedDict
 from typing import List, Dict
-from pymilvus import Collection, connections
+from pymilvus import DataType
+from .milvus_client import connect, get_collection, default_search_params, bump_collection_version, collection_version
+
+logger = logging.getLogger(__name__)
+logger.setLevel(os.getenv('LOG_LEVEL', 'WARNING'))
+
+def to_vector_field(collection, embeddings, field_name="embedding"):
+    """
+    Convert embeddings to the compact array type of a collection's vector field
+    
+    Rows are passed to pymilvus as contiguous float32 (or float16 for
+    FLOAT16_VECTOR fields) arrays instead of nested Python float lists, halving
+    the payload of float64 inputs and skipping per-float boxing on insert.
+    
+    Args:
+        collection: The Milvus collection being inserted into
+        embeddings: Embeddings as a 2D array or a list of vectors
+        field_name: Name of the vector field
+    """
+    dtype = np.float32
+    for field in collection.schema.fields:
+        if field.name == field_name and field.dtype == DataType.FLOAT16_VECTOR:
+            dtype = np.float16
+    return list(np.ascontiguousarray(embeddings, dtype=dtype))
+
+def hash_document(document_path):
+    """Compute a BLAKE2b content hash of a file, matching the frontend's upload hash"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(document_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _doc_id_prefix(meta):
+    """Key prefix of a segment: its document's content hash, or the file name if there is none"""
+    meta = meta or {}
+    return (meta.get('document_hash') or os.path.basename(meta.get('document_path') or '')[:200]) + "_"
+
+def make_doc_id(text, document_path="", document_hash=None):
+    """
+    Derive a stable primary key for a text segment from its source document and content
+    
+    The document part is its content hash when given (uploads arrive under a
+    new temporary path every time), so re-ingesting an unchanged segment
+    produces the same key and upserts replace it instead of adding a duplicate row.
+    """
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+    return _doc_id_prefix({'document_hash': document_hash, 'document_path': document_path}) + digest
+
+def make_doc_ids(texts, metadata_list):
+    """
+    Build make_doc_id keys for a batch of segments
+    
+    Equivalent to calling make_doc_id per segment with the metadata's
+    'document_hash' and 'document_path', but each distinct document's prefix is
+    computed once and the hash constructor is bound locally.
+    """
+    blake2b = hashlib.blake2b
+    prefixes = {}
+    doc_ids = []
+    for text, meta in zip(texts, metadata_list):
+        meta = meta or {}
+        source = (meta.get('document_hash'), meta.get('document_path'))
+        prefix = prefixes.get(source)
+        if prefix is None:
+            prefix = prefixes[source] = _doc_id_prefix(meta)
+        doc_ids.append(prefix + blake2b(text.encode('utf-8'), digest_size=8).hexdigest())
+    return doc_ids
+
+# Byte limit of the text field (its VARCHAR max_length in setup_milvus)
+MAX_TEXT_BYTES = 4096
+
+def text_fits_field(text, max_bytes=MAX_TEXT_BYTES):
+    """Check that a text fits the text field's byte limit"""
+    # A character is at most 4 bytes, so short texts can't exceed the limit
+    return len(text) * 4 <= max_bytes or len(text.encode('utf-8')) <= max_bytes
+
+def split_text_field(text, max_bytes=MAX_TEXT_BYTES):
+    """
+    Split a text into pieces that each fit the text field, so no text is dropped
+    
+    Pieces break at the last space or newline within the limit where there is
+    one, and otherwise on a UTF-8 character boundary.
+    
+    Args:
+        text: The text to split
+        max_bytes: Byte limit of each piece
+        
+    Returns:
+        List of pieces, just [text] if it already fits
+    """
+    if text_fits_field(text, max_bytes):
+        return [text]
+    
+    encoded = text.encode('utf-8')
+    pieces = []
+    while len(encoded) > max_bytes:
+        cut = max(encoded.rfind(b' ', 0, max_bytes + 1), encoded.rfind(b'\n', 0, max_bytes + 1))
+        if cut <= 0:
+            # No whitespace to break at; back up to the start of a character
+            cut = max_bytes
+            while cut > 0 and (encoded[cut] & 0xC0) == 0x80:
+                cut -= 1
+        pieces.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:].lstrip()
+    if encoded:
+        pieces.append(encoded.decode('utf-8'))
+    return pieces
+
+def dedupe_rows(doc_ids, *columns):
+    """Drop rows whose doc_id repeats within one batch, keeping the first"""
+    first = {}
+    for i, doc_id in enumerate(doc_ids):
+        first.setdefault(doc_id, i)
+    if len(first) == len(doc_ids):
+        return (doc_ids, *columns)
+    keep = list(first.values())
+    return ([doc_ids[i] for i in keep], *([column[i] for i in keep] for column in columns))
+
+def _format_hits(hits):
+    """Turn the hits of one query into result dicts"""
+    formatted_results = []
+    for hit in hits:
+        try:
+            formatted_results.append({
+                'text': hit.entity.text,
+                'metadata': hit.entity.metadata,
+                'doc_id': hit.entity.doc_id,
+                'score': hit.distance
+            })
+        except Exception as e:
+            logger.warning("Error processing hit: %s", e)
+    return formatted_results
+
+def _search_vectors(collection, vectors, k, search_params):
+    """Search several query vectors in one Milvus request, returning results per vector"""
+    results = collection.search(
+        data=to_vector_field(collection, vectors),
+        anns_field="embedding",
+        param=search_params,
+        limit=k,
+        output_fields=["text", "metadata", "doc_id"]
+    )
+    return [_format_hits(hits) for hits in results]
+
+# Results of recent single-vector searches. Keys include the collection's write
+# version, so writes from this process invalidate them at once; the TTL bounds how
+# long writes from other processes can go unseen
+_SEARCH_CACHE = OrderedDict()
+_SEARCH_CACHE_LOCK = threading.Lock()
+_SEARCH_CACHE_SIZE = 4096
+_SEARCH_CACHE_TTL = 300  # seconds
+
+def _search_cache_get(cache_key):
+    """Get a copy of unexpired cached search results, or None"""
+    with _SEARCH_CACHE_LOCK:
+        entry = _SEARCH_CACHE.get(cache_key)
+        if entry is None:
+            return None
+        stored_at, results = entry
+        if time.monotonic() - stored_at > _SEARCH_CACHE_TTL:
+            del _SEARCH_CACHE[cache_key]
+            return None
+        _SEARCH_CACHE.move_to_end(cache_key)
+    # Copied so callers can't modify the cached results
+    return copy.deepcopy(results)
+
+def _search_cache_put(cache_key, results):
+    """Store a copy of search results, evicting the least recently used entries"""
+    results = copy.deepcopy(results)
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE[cache_key] = (time.monotonic(), results)
+        _SEARCH_CACHE.move_to_end(cache_key)
+        while len(_SEARCH_CACHE) > _SEARCH_CACHE_SIZE:
+            _SEARCH_CACHE.popitem(last=False)
 
 class VectorStore:
-    def __init__(self, collection_name="vector_db", dimension=1024):
+    def __init__(self, collection_name="vector_db", dimension=1024, search_params=None):
         self.dimension = dimension
         self.collection_name = collection_name
+        self.search_params = search_params
         
         # Connect to Milvus Cloud
         try:
-            connections.connect(
-                "default",
-                uri=os.getenv('MILVUS_URI'),
-                token=os.getenv('MILVUS_TOKEN')
-            )
-            print(f"Connected to Milvus Cloud for {collection_name}")
+            connect()
             
             # Get or create collection
             if self._collection_exists():
-                self.collection = Collection(collection_name)
-                print(f"Using existing collection: {collection_name}")
+                self.collection = get_collection(collection_name)
+                logger.info("Using existing collection: %s", collection_name)
+                # Search parameters matching the collection's index (read once), unless given
+                if self.search_params is None:
+                    self.search_params = default_search_params(self.collection)
             else:
-                print(f"Collection {collection_name} does not exist. Please run setup_milvus.py first.")
+                logger.warning("Collection %s does not exist. Please run setup_milvus.py first.", collection_name)
                 
             # Load collection into memory
             try:
                 self.collection.load()
             except Exception as e:
-                print(f"Warning: Could not load collection: {str(e)}")
+                logger.warning("Could not load collection: %s", e)
                 
         except Exception as e:
-            print(f"Error connecting to Milvus: {str(e)}")
+            logger.warning("Error connecting to Milvus: %s", e)
             
     def _collection_exists(self):
         """Check if collection exists in Milvus"""
@@ -44,25 +224,37 @@ class VectorStore:
             raise ValueError("Number of documents must match number of embeddings")
             
         # Format data for Milvus
-        doc_ids = [f"doc_{i}" for i in range(len(documents))]
         texts = [doc.get('text', '') for doc in documents]
         
         # Use provided metadata or empty dicts
         if metadata_list is None:
             metadata_list = [{} for _ in documents]
+        
+        # Texts are stored whole; longer ones must be split (see split_text_field) before embedding
+        too_long = sum(not text_fits_field(text) for text in texts)
+        if too_long:
+            raise ValueError(f"{too_long} documents exceed the {MAX_TEXT_BYTES}-byte text field; split them with split_text_field")
+        
+        # Content-hash keys make re-adding the same documents a no-op
+        doc_ids = make_doc_ids(texts, metadata_list)
+        doc_ids, texts, vectors, metadata_list = dedupe_rows(
+            doc_ids, texts, to_vector_field(self.collection, embeddings), metadata_list
+        )
             
-        # Insert into Milvus
-        insert_result = self.collection.insert([
-            doc_ids,                # doc_id field
+        # Upsert into Milvus
+        upsert_result = self.collection.upsert([
+            doc_ids,                # doc_id field (primary key)
             texts,                  # text field
-            embeddings.tolist(),    # embedding field
+            vectors,                # embedding field
             metadata_list           # metadata field
         ])
         
+        bump_collection_version(self.collection_name)
+        
         # Flush to ensure data is persisted
         self.collection.flush()
         
-        return insert_result.insert_count
+        return upsert_result.upsert_count
         
     def search(self, query_embedding: np.ndarray, k: int = 5):
         """Search for similar documents"""
@@ -70,50 +262,70 @@ class VectorStore:
         try:
             self.collection.load()
         except Exception as e:
-            print(f"Warning: Error loading collection: {str(e)}")
+            logger.warning("Error loading collection: %s", e)
             
-        # Search parameters
-        search_params = {"metric_type": "L2", "params": {"nprobe": 10}}
-        
-        # Perform search
-        results = self.collection.search(
-            data=[query_embedding.tolist()],
-            anns_field="embedding",
-            param=search_params,
-            limit=k,
-            output_fields=["text", "metadata", "doc_id"]
+        # Perform search, reusing recent results for the same vector; rounding to 1e-6
+        # lets near-identical embeddings of the same query share an entry
+        vector = np.round(np.asarray(query_embedding, dtype=np.float32).reshape(1, -1), 6)
+        cache_key = (
+            self.collection_name,
+            collection_version(self.collection_name),
+            vector.tobytes(),
+            k,
+            json.dumps(self.search_params, sort_keys=True)
         )
+        results = _search_cache_get(cache_key)
+        if results is None:
+            results = _search_vectors(self.collection, vector, k, self.search_params)[0]
+            # Empty results may come from a partly loaded collection, so they aren't cached
+            if results:
+                _search_cache_put(cache_key, results)
+        return results
+    
+    def search_batch(self, query_embeddings: np.ndarray, k: int = 5):
+        """
+        Search several query vectors with a single Milvus request
         
-        # Format results
-        formatted_results = []
-        for hit in results[0]:
-            try:
-                formatted_results.append({
-                    'text': hit.entity.text,
-                    'metadata': hit.entity.metadata,
-                    'doc_id': hit.entity.doc_id,
-                    'score': hit.distance
-                })
-            except Exception as e:
-                print(f"Error processing hit: {str(e)}")
-                
-        return formatted_results
+        Milvus computes distances for all nq vectors together, so one request for
+        N queries costs far less proxy and serialization overhead than N requests.
+        Results are not cached; use search for repeated single queries.
+        
+        Args:
+            query_embeddings: Query vectors as an (N, dim) array or a list of vectors
+            k: Number of results per query
+            
+        Returns:
+            List with the search results of each query, in order
+        """
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if not query_embeddings.size:
+            return []
+        if query_embeddings.ndim == 1:
+            query_embeddings = query_embeddings.reshape(1, -1)
+        
+        # Ensure collection is loaded
+        try:
+            self.collection.load()
+        except Exception as e:
+            logger.warning("Error loading collection: %s", e)
+            
+        return _search_vectors(self.collection, query_embeddings, k, self.search_params)
     
     def save(self, path: str):
         """Save the index to disk"""
         # Milvus is a cloud service, so we don't need to save the index locally
         # This method is kept for API compatibility
-        print(f"Note: Milvus collections are stored in the cloud. No local save needed.")
+        logger.info("Milvus collections are stored in the cloud. No local save needed.")
         return True
         
     def load(self, path: str):
         """Load the index from disk"""
         # Milvus is a cloud service, so we don't need to load the index from disk
         # This method is kept for API compatibility
-        print(f"Note: Milvus collections are loaded from the cloud. No local load needed.")
+        logger.info("Milvus collections are loaded from the cloud. No local load needed.")
         # Ensure collection is loaded in memory
         try:
             self.collection.load()
-            print(f"Collection {self.collection_name} loaded into memory")
+            logger.info("Collection %s loaded into memory", self.collection_name)
         except Exception as e:
-            print(f"Warning: Error loading collection: {str(e)}") 
\ No newline at end of file
+            logger.warning("Error loading collection: %s", e) 
\ No newline at end of file
@@ -11,23 +11,32 @@ def create_init_files(root_dir):
     print(f"Creating __init__.py files in {root_dir} and subdirectories...")
     
     # Skip these directories
-    skip_dirs = [".git", "__pycache__", "venv", "env", ".venv", "fresh_env", "static"]
+    skip_dirs = {".git", "__pycache__", "venv", "env", ".venv", "fresh_env", "static"}
     
     # Count of files created
     count = 0
     
-    # Walk through all directories
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        # Skip directories we want to exclude
-        dirnames[:] = [d for d in dirnames if d not in skip_dirs]
+    # Depth-first walk with os.scandir, whose entries already know whether they are directories
+    stack = [root_dir]
+    while stack:
+        dirpath = stack.pop()
         
-        # Check if __init__.py already exists
+        # Create __init__.py unless it already exists (one exclusive open instead of exists + open)
         init_file = os.path.join(dirpath, "__init__.py")
-        if not os.path.exists(init_file):
-            with open(init_file, 'w') as f:
+        try:
+            with open(init_file, 'x') as f:
                 f.write("# Auto-generated __init__.py file\n")
             print(f"Created: {init_file}")
             count += 1
+        except FileExistsError:
+            pass
+        
+        # Queue subdirectories, skipping the ones we want to exclude (symlinks aren't followed, as with os.walk)
+        with os.scandir(dirpath) as entries:
+            stack.extend(
+                entry.path for entry in entries
+                if entry.name not in skip_dirs and entry.is_dir(follow_symlinks=False)
+            )
     
     print(f"Done! Created {count} __init__.py files.")
 
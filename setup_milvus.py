@@ -5,86 +5,257 @@ from pymilvus import (
     CollectionSchema,
     DataType,
     Collection,
+    BulkInsertState,
 )
-from dotenv import load_dotenv
+from collections import deque
+from utils.env import load_env
+from core.vector_store.milvus_client import connect, get_collection, default_search_params
+from core.vector_store.store import to_vector_field, MAX_TEXT_BYTES
+import numpy as np
+import json
 import os
-import random
+import time
 
 # Load environment variables
-load_dotenv()
+load_env()
 
-def setup_milvus():
+# Rows per insert call; Milvus handles batches of around 10k entities best
+INSERT_BATCH_SIZE = 10000
+
+# Shards spread inserts over several datanodes (one shard means one datanode does all
+# the work); keep this at or below the number of datanodes
+SHARDS_NUM = int(os.getenv('MILVUS_SHARDS', '4'))
+
+# Memory-map the text and raw vector fields so they page in from disk on demand;
+# the quantized IVF_RABITQ codes stay in RAM, only the refined SQ8 vectors and
+# segment text are read lazily. Set MILVUS_MMAP=0 to keep everything resident.
+MMAP_ENABLED = os.getenv('MILVUS_MMAP', '1') == '1'
+
+# Seeded generator for test vectors; draws whole (n, dim) arrays in C rather than per element
+_RNG = np.random.default_rng(0)
+
+# Vector index options, chosen with MILVUS_INDEX_TYPE.
+# IVF_RABITQ stores 1-bit RaBitQ codes (~32x smaller than FP32) and re-ranks
+# candidates with SQ8 vectors, for much higher throughput at ~95% recall.
+# HNSW answers queries by graph traversal with the lowest latency and highest
+# recall, but keeps the full vectors plus graph links (~M * 2 neighbours per
+# vector per layer) in memory, so it costs the most RAM; pick it for
+# latency-sensitive workloads and IVF_RABITQ when memory matters more.
+# IVF_FLAT keeps the raw vectors, for exact-recall validation runs.
+INDEX_PARAMS = {
+    "IVF_RABITQ": {
+        "metric_type": "COSINE",
+        "index_type": "IVF_RABITQ",
+        "params": {"nlist": 1024, "refine": True, "refine_type": "SQ8"}
+    },
+    "HNSW": {
+        "metric_type": "L2",
+        "index_type": "HNSW",
+        "params": {"M": 16, "efConstruction": 200}
+    },
+    "IVF_FLAT": {
+        "metric_type": "L2",
+        "index_type": "IVF_FLAT",
+        "params": {"nlist": 128}
+    },
+}
+
+def _schema_matches(existing, expected):
+    """Check that a collection schema has the expected field names, types and primary key"""
+    def describe(schema):
+        return [(field.name, field.dtype, field.is_primary) for field in schema.fields]
+    return describe(existing) == describe(expected)
+
+def setup_milvus(create_index=False):
+    """
+    Create the vector_db collection, or reuse it if it already exists with the same schema
+    
+    Set MILVUS_RESET=1 to drop and recreate an existing collection.
+    
+    Args:
+        create_index: Build the vector index right away. By default it is left to
+            finalize_index, so bulk loads don't retrain IVF clusters batch by batch
+    """
     print("=== Start connecting to Milvus Cloud ===")
     
-    # Connect to Milvus Cloud using URI and token
-    connections.connect(
-        alias="default",
-        uri=os.getenv('MILVUS_URI'),
-        token=os.getenv('MILVUS_TOKEN')
-    )
+    # Connect to Milvus Cloud once per process (shared with the pipelines)
+    connect()
     
     collection_name = "vector_db"
     
-    # Check if collection exists
-    print(f"\nDoes collection {collection_name} exist in Milvus: {utility.has_collection(collection_name)}")
-
-    # Drop collection if it exists
-    if utility.has_collection(collection_name):
-        utility.drop_collection(collection_name)
-
     # Define fields
     fields = [
-        FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=True),
-        FieldSchema(name="doc_id", dtype=DataType.VARCHAR, max_length=256),  # Links to Document Store
-        FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65535),  # Original Text Content
-        FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=1024),  # NVIDIA E5 Embeddings
+        # Content-hash key (see make_doc_id), so re-ingested segments are upserted in place
+        FieldSchema(name="doc_id", dtype=DataType.VARCHAR, max_length=256, is_primary=True),  # Links to Document Store
+        # Original text content, sized for typical segments rather than the 64KB maximum;
+        # ingestion splits longer segments into several rows (split_text_field), so no text is lost
+        FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=MAX_TEXT_BYTES, mmap_enabled=MMAP_ENABLED),
+        # NVIDIA E5 embeddings tolerate FP16, which halves vector bytes (2KB/row) for memory-bound search
+        FieldSchema(name="embedding", dtype=DataType.FLOAT16_VECTOR, dim=1024, mmap_enabled=MMAP_ENABLED),
         FieldSchema(name="metadata", dtype=DataType.JSON)  # Any extra metadata
     ]
 
     # Define schema
-    schema = CollectionSchema(fields, description="Vector DB for document embeddings")
+    # Dynamic fields let rows carry extra keys without a schema change
+    schema = CollectionSchema(fields, description="Vector DB for document embeddings", enable_dynamic_field=True)
+
+    # Check if collection exists
+    exists = utility.has_collection(collection_name)
+    print(f"\nDoes collection {collection_name} exist in Milvus: {exists}")
+    
+    # Reuse an existing collection unless a reset is requested
+    if exists and os.getenv('MILVUS_RESET') != '1':
+        collection = get_collection(collection_name)
+        if not _schema_matches(collection.schema, schema):
+            raise ValueError(f"Collection {collection_name} has a different schema; set MILVUS_RESET=1 to recreate it")
+        print(f"Reusing existing collection {collection_name}")
+        return collection
+    
+    # Drop collection if it exists, reusing the has_collection answer above; another
+    # setup run may have dropped it in the meantime, which is fine
+    if exists:
+        try:
+            utility.drop_collection(collection_name)
+        except Exception as e:
+            print(f"Warning: Could not drop collection {collection_name}: {str(e)}")
+        get_collection.cache_clear()  # Drop the handle to the old collection
 
     # Create collection
-    collection = Collection("vector_db", schema)
+    Collection(collection_name, schema, shards_num=SHARDS_NUM)
+    collection = get_collection(collection_name)
 
-    # Create IVF_FLAT index for vector field
-    index_params = {
-        "metric_type": "L2",
-        "index_type": "IVF_FLAT",
-        "params": {"nlist": 128}
-    }
-    collection.create_index("embedding", index_params)
+    if create_index:
+        finalize_index(collection)
         
     return collection
 
+def finalize_index(collection):
+    """
+    Build the vector index once the initial rows are inserted, and wait for it
+    
+    Index building runs on Milvus' index nodes, one task per sealed segment, so
+    scaling the indexNode replicas (indexNode.replicas in the Helm values) lets
+    segments index in parallel. Rows inserted later are indexed in the background
+    as their segments are flushed. Does nothing if the collection already has an index.
+    
+    Args:
+        collection: The collection to index
+    """
+    if collection.has_index():
+        return
+    
+    # IVF_RABITQ unless MILVUS_INDEX_TYPE says otherwise
+    index_type = os.getenv('MILVUS_INDEX_TYPE', 'IVF_RABITQ')
+    if index_type not in INDEX_PARAMS:
+        raise ValueError(f"Unsupported MILVUS_INDEX_TYPE {index_type}; expected one of {', '.join(INDEX_PARAMS)}")
+    
+    # Seal the inserted rows into segments so the index is built over all of them
+    collection.flush()
+    collection.create_index("embedding", INDEX_PARAMS[index_type])
+    utility.wait_for_index_building_complete(collection.name)
+    print(f"Built {index_type} index on {collection.name}")
+
+def insert_batched(collection, doc_ids, texts, vectors, metadata, batch_size=INSERT_BATCH_SIZE, max_inflight=SHARDS_NUM):
+    """
+    Insert rows in batches, with several insert calls in flight at once
+    
+    Inserts are sent with _async=True, so the next batch is sliced and encoded
+    while earlier batches are still being written to the WAL; once max_inflight
+    requests are pending, the oldest is waited on before sending another.
+    
+    Args:
+        collection: The collection to insert into
+        doc_ids, texts, vectors, metadata: Column values; vectors is an (N, dim) float array
+        batch_size: Rows per insert call
+        max_inflight: Insert calls in flight at once (defaults to one per shard)
+        
+    Returns:
+        Number of rows inserted
+    """
+    # Convert once to one contiguous buffer of the field's dtype (float16 here); each batch
+    # then slices row views of it, which pymilvus serializes without per-element copies
+    vectors = to_vector_field(collection, vectors)
+    
+    inserted = 0
+    pending = deque()
+    for start in range(0, len(doc_ids), batch_size):
+        end = start + batch_size
+        pending.append(collection.insert([
+            doc_ids[start:end],
+            texts[start:end],
+            vectors[start:end],
+            metadata[start:end]
+        ], _async=True))
+        if len(pending) >= max_inflight:
+            inserted += pending.popleft().result().insert_count
+    
+    # Wait for the remaining batches
+    while pending:
+        inserted += pending.popleft().result().insert_count
+    return inserted
+
+def bulk_insert(collection_name, files, poll_interval=2):
+    """
+    Import pre-staged row files (JSON/Parquet/NumPy) with Milvus bulk insert
+    
+    Bulk insert skips the write-ahead log, which makes it much faster for large
+    loads, but consistency is relaxed: rows only become searchable once the
+    import task has completed and its segments are indexed, not as soon as they
+    are sent. The files must already be in the object storage bucket Milvus reads.
+    
+    Args:
+        collection_name: The collection to import into
+        files: Paths of the files within the bucket
+        poll_interval: Seconds between import state checks
+        
+    Returns:
+        Number of rows imported
+    """
+    task_id = utility.do_bulk_insert(collection_name=collection_name, files=files)
+    print(f"Started bulk insert task {task_id} for {len(files)} files")
+    
+    while True:
+        state = utility.get_bulk_insert_state(task_id)
+        if state.state == BulkInsertState.ImportCompleted:
+            return state.row_count
+        if state.state in (BulkInsertState.ImportFailed, BulkInsertState.ImportFailedAndCleaned):
+            raise Exception(f"Bulk insert failed: {state.failed_reason}")
+        time.sleep(poll_interval)
+
 def test_milvus_connection():
     try:
         # Create collection
         collection = setup_milvus()
         
-        # Insert some test data
-        entities = [
-            ["This is a test document 1", [random.random() for _ in range(1024)], {"source": "test"}],
-            ["This is a test document 2", [random.random() for _ in range(1024)], {"source": "test"}]
-        ]
+        # Insert some test data (set MILVUS_TEST_ROWS to load-test larger inserts)
+        bulk_files = [path for path in os.getenv('MILVUS_BULK_FILES', '').split(',') if path]
+        test_ids = []
+        if bulk_files:
+            # Opt-in path for large pre-staged loads
+            inserted = bulk_insert(collection.name, bulk_files)
+        else:
+            n = int(os.getenv('MILVUS_TEST_ROWS', '2'))
+            test_ids = [f"test_{i}" for i in range(n)]
+            inserted = insert_batched(
+                collection,
+                test_ids,                                           # doc_id
+                [f"This is a test document {i + 1}" for i in range(n)],  # text
+                _RNG.random((n, 1024), dtype=np.float32).astype(np.float16),  # embeddings, one (n, 1024) float16 block
+                [{"source": "test"}] * n                            # metadata
+            )
+        print(f"Inserted {inserted} test rows")
         
-        collection.insert([
-            [entity[0] for entity in entities],  # text
-            [entity[1] for entity in entities],  # embeddings
-            [entity[2] for entity in entities]   # metadata
-        ])
+        # Index after the insert (a no-op for a reused, already indexed collection)
+        finalize_index(collection)
         
-        # Load collection
-        collection.load()
+        # Load collection (once; the pipelines reuse the same loaded collection)
+        collection.load(_async=False)
         
-        # Perform a test search
-        search_params = {
-            "metric_type": "L2",
-            "params": {"nprobe": 10},
-        }
+        # Perform a test search with the parameters the pipelines use for this index
+        search_params = default_search_params(collection)
         
         results = collection.search(
-            data=[[random.random() for _ in range(1024)]],  # Query vector
+            data=to_vector_field(collection, _RNG.random((1, 1024), dtype=np.float32)),  # Query vector
             anns_field="embedding",
             param=search_params,
             limit=2,
@@ -96,6 +267,10 @@ def test_milvus_connection():
             for hit in hits:
                 print(f"hit: (distance: {hit.distance}, text: {hit.entity.get('text')})")
         
+        # Remove the test rows, since the collection may hold real documents
+        if test_ids:
+            collection.delete(f"doc_id in {json.dumps(test_ids)}")
+        
         print("\nMilvus Cloud setup and test completed successfully!")
         
     except Exception as e:
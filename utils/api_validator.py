@@ -1,42 +1,49 @@
 import os
-from dotenv import load_dotenv
+from utils.env import load_env
+
+# Make .env values visible to the validators (a no-op if already loaded)
+load_env()
+
+# Required settings, as tuples so they're built once at import
+_REQUIRED_KEYS = (
+    'NVIDIA_YOLOX_KEY',
+    'NVIDIA_DEPLOT_KEY',
+    'NVIDIA_EMBEDDING_KEY',
+    'NVIDIA_PADDLEOCR_KEY',
+    'NVIDIA_CACHED_KEY',
+    'NVIDIA_RERANK_KEY',
+    'NVIDIA_LLM_KEY'
+)
+
+_REQUIRED_ENDPOINTS = (
+    'NVIDIA_YOLOX_ENDPOINT',
+    'NVIDIA_DEPLOT_ENDPOINT',
+    'NVIDIA_EMBEDDING_ENDPOINT',
+    'NVIDIA_PADDLEOCR_ENDPOINT',
+    'NVIDIA_CACHED_ENDPOINT',
+    'NVIDIA_RERANK_ENDPOINT',
+    'NVIDIA_LLM_ENDPOINT'
+)
+
+def _missing(names):
+    """Return the names that are unset or empty in the environment"""
+    environ = os.environ
+    return tuple(name for name in names if not environ.get(name))
 
 def validate_api_keys():
     """Validate that all required API keys are present"""
-    required_keys = [
-        'NVIDIA_YOLOX_KEY',
-        'NVIDIA_DEPLOT_KEY',
-        'NVIDIA_EMBEDDING_KEY',
-        'NVIDIA_PADDLEOCR_KEY',
-        'NVIDIA_CACHED_KEY',
-        'NVIDIA_RERANK_KEY',
-        'NVIDIA_LLM_KEY'
-    ]
-    
-    missing_keys = []
-    for key in required_keys:
-        if not os.getenv(key):
-            missing_keys.append(key)
-    
+    missing_keys = _missing(_REQUIRED_KEYS)
     if missing_keys:
         raise ValueError(f"Missing required API keys: {', '.join(missing_keys)}")
 
 def validate_endpoints():
     """Validate that all required endpoints are configured"""
-    required_endpoints = [
-        'NVIDIA_YOLOX_ENDPOINT',
-        'NVIDIA_DEPLOT_ENDPOINT',
-        'NVIDIA_EMBEDDING_ENDPOINT',
-        'NVIDIA_PADDLEOCR_ENDPOINT',
-        'NVIDIA_CACHED_ENDPOINT',
-        'NVIDIA_RERANK_ENDPOINT',
-        'NVIDIA_LLM_ENDPOINT'
-    ]
-    
-    missing_endpoints = []
-    for endpoint in required_endpoints:
-        if not os.getenv(endpoint):
-            missing_endpoints.append(endpoint)
-    
+    missing_endpoints = _missing(_REQUIRED_ENDPOINTS)
     if missing_endpoints:
-        raise ValueError(f"Missing required endpoints: {', '.join(missing_endpoints)}") 
\ No newline at end of file
+        raise ValueError(f"Missing required endpoints: {', '.join(missing_endpoints)}")
+
+def validate_env():
+    """Validate all required API keys and endpoints in one pass, reporting everything missing at once"""
+    missing = _missing(_REQUIRED_KEYS + _REQUIRED_ENDPOINTS)
+    if missing:
+        raise EnvironmentError(f"Missing required API keys/endpoints: {', '.join(missing)}")
@@ -0,0 +1,25 @@
+import os
+import functools
+from dotenv import dotenv_values, find_dotenv
+
+# The project's .env lives at the repository root
+_DEFAULT_ENV_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '.env')
+
+@functools.lru_cache(maxsize=None)
+def load_env(path=None):
+    """
+    Read .env into os.environ once per process
+
+    Later calls (from any module) return without touching the file. As with
+    load_dotenv, variables that are already set in the environment win.
+
+    Args:
+        path: The .env file (defaults to the repository root's, then the nearest one to the working directory)
+    """
+    path = path or (_DEFAULT_ENV_FILE if os.path.exists(_DEFAULT_ENV_FILE) else find_dotenv(usecwd=True))
+    if not path:
+        return
+    os.environ.update({
+        key: value for key, value in dotenv_values(path).items()
+        if value is not None and key not in os.environ
+    })
@@ -0,0 +1,35 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def create_session(pool_connections=16, pool_maxsize=32, retries=3, connect_retries=None,
+                   read_retries=None):
+    """
+    Create a requests session with pooled keep-alive connections and retries
+
+    Requests are retried with exponential backoff on connection errors and on
+    429/5xx responses. Once retries are exhausted the last response is returned
+    instead of raising, so callers keep their own status code handling.
+
+    Args:
+        pool_connections: Number of host connection pools to keep
+        pool_maxsize: Maximum connections kept alive per host
+        retries: Total number of retries per request
+        connect_retries: Retries on connection errors (defaults to `retries`)
+        read_retries: Retries on read errors and timeouts (defaults to `retries`)
+    """
+    retry = Retry(
+        total=retries,
+        connect=connect_retries,
+        read=read_retries,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=None,  # The APIs used here are all POST
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session